@@ -12,6 +12,8 @@ from .gemini_chat import (
     stream_chat,
     stream_chat_openai,
     create_multimodal_message,
+    create_context_cache,
+    delete_context_cache,
 )
 
 # auto_stream_processor
@@ -56,6 +58,8 @@ __all__ = [
     "stream_chat",
     "stream_chat_openai",
     "create_multimodal_message",
+    "create_context_cache",
+    "delete_context_cache",
     # auto_stream_processor
     "CallbackMsgType",
     "APIType",
@@ -1,4 +1,35 @@
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from enum import Enum
+from typing import (
+    TYPE_CHECKING,
+    List,
+    Optional,
+    Callable,
+    Sequence,
+    Tuple,
+    Awaitable,
+    Union,
+)
+
+from .gemini_chat import (
+    stream_chat,
+    stream_chat_openai,
+    create_context_cache,
+    delete_context_cache,
+    StreamCancellation,
+    ChatMessage,
+    MediaFile,
+    MessageRole,
+)
+from .template import cot_template, ToolCodeInfo
+from .tool_code import DefaultApi, eval_tool_code
+
+if TYPE_CHECKING:
+    import aiohttp
 
 
 # 回调消息类型枚举
@@ -16,18 +47,223 @@ class APIType(Enum):
     OPENAI = "openai"  # OpenAI 兼容API
 
 
-from .gemini_chat import (
-    stream_chat,
-    stream_chat_openai,
-    StreamCancellation,
-    ChatMessage,
-    MessageRole,
+# call_tool_code 块的头部标签
+_CALL_BLOCK_HEADER = "<reactAgentSegmentHeader>call_tool_code</reactAgentSegmentHeader>"
+
+# 用户消息的段落标记
+_USER_MESSAGE_HEADER = "<reactAgentSegmentHeader>user_message</reactAgentSegmentHeader>"
+
+# 最终回复的段落标记，AI必须输出该标记才算完成处理
+_SEND_RESPONSE_TAG = (
+    "<reactAgentSegmentHeader>send_response_to_user</reactAgentSegmentHeader>"
 )
-from .template import cot_template, ToolCodeInfo
-from .tool_code import DefaultApi, eval_tool_code
-import re
-import asyncio
-from typing import List, Optional, Callable, Tuple, Awaitable, Union
+
+# AI输出中缺少最终回复标记时，以user角色发送的系统警告
+_MISSING_RESPONSE_TAG_ALERT = (
+    "<reactAgentSegmentHeader>system_alert</reactAgentSegmentHeader>\n"
+    f"No `{_SEND_RESPONSE_TAG}` tag detected in the response. "
+    "This response is invalid. "
+    f"Please ensure your final response includes the `{_SEND_RESPONSE_TAG}` tag "
+    "and try again."
+)
+
+# 以assistant消息伪造ToolCode返回值时使用的系统反馈片段
+_SYSTEM_FEEDBACK_HEADER = (
+    "<reactAgentSegmentHeader>system_feedback</reactAgentSegmentHeader>\n"
+)
+_MAX_ITERATION_SUFFIX = (
+    _SYSTEM_FEEDBACK_HEADER
+    + "YOU HAVE REACHED THE MAXIMUM ITERATION COST. OUTPUT YOUR FINAL RESPONSE NOW."
+)
+_CONTINUE_FEEDBACK = (
+    _SYSTEM_FEEDBACK_HEADER
+    + "continue ReAct processing by using "
+    + "`<reactAgentSegmentHeader>think</reactAgentSegmentHeader>`"
+)
+# ToolCode返回值的固定前缀，执行结果直接拼接在其后
+_TOOL_RESULT_PREFIX = _SYSTEM_FEEDBACK_HEADER + "Tool Result:\n"
+
+# tool_code 代码块的开闭围栏，ToolCode检测直接用 str.find 查找，无需正则
+_TOOL_CODE_OPEN = "```tool_code\n"
+_TOOL_CODE_CLOSE = "\n```"
+
+# 流式回调队列的容量，用户回调落后过多时对上游读取施加背压
+_STREAM_QUEUE_SIZE = 64
+
+# ToolCode执行结果缓存的最大条目数 (仅当 DefaultApi.cacheable 为 True 时使用)
+_TOOL_CACHE_SIZE = 128
+
+# 查找头部时需要保留的前文尾部长度(负数切片)，以覆盖跨chunk被截断的头部
+_HEADER_TAIL_LEN = 1 - len(_CALL_BLOCK_HEADER)
+
+
+class _ToolCodeScanner:
+    """
+    流式ToolCode检测器：逐chunk喂入AI输出，检测最后一个call_tool_code块内部的tool_code块
+
+    每个chunk只在新增内容中查找头部和围栏(回退一个模式长度以覆盖跨chunk截断的情况)，
+    已扫描过的内容不再重复扫描。出现头部之前不拼接任何内容；出现头部之后，
+    只拼接从最后一个头部开始的检测区域，头部之前的内容不再参与检测。
+    """
+
+    __slots__ = (
+        "length",
+        "saw_header",
+        "header_tail",
+        "active",
+        "active_start",
+        "scan_cursor",
+        "call_block_pos",
+        "fence_pos",
+    )
+
+    def __init__(self):
+        self.active: List[str] = []
+        self.reset()
+
+    def reset(self) -> None:
+        """开始新一轮流式输出前重置状态"""
+        # 已喂入的总长度
+        self.length = 0
+        # 是否已出现 call_tool_code 头部；出现前只需在新chunk及上一段的尾部中查找头部
+        self.saw_header = False
+        self.header_tail = ""
+        # 检测区域的chunk，以及检测区域在完整输出中的起始位置
+        self.active.clear()
+        self.active_start = 0
+        # 检测区域内的增量扫描状态
+        self.scan_cursor = 0
+        self.call_block_pos = -1
+        self.fence_pos = -1
+
+    def feed(self, chunk: str) -> Optional[Tuple[str, int, int]]:
+        """
+        喂入一个chunk
+
+        Returns:
+            如果tool_code块已完整出现，返回 (toolcode_content, start_pos, end_pos)，
+            坐标为在完整输出中的位置
+        """
+        self.length += len(chunk)
+        active = self.active
+        if not self.saw_header:
+            window = self.header_tail + chunk
+            if _CALL_BLOCK_HEADER not in window:
+                self.header_tail = window[_HEADER_TAIL_LEN:]
+                return None
+            self.saw_header = True
+            # 检测区域从包含第一个头部的窗口开始
+            active.append(window)
+            self.active_start = self.length - len(window)
+        else:
+            active.append(chunk)
+            # ToolCode块只会在收到闭合的```时完成，不含反引号的chunk无需检测
+            if "`" not in chunk:
+                return None
+
+        # 只在需要检测时拼接检测区域
+        active_text = "".join(active)
+        toolcode_match = self.detect(active_text)
+        if toolcode_match:
+            toolcode_content, start_pos, end_pos = toolcode_match
+            offset = self.active_start
+            return (toolcode_content, start_pos + offset, end_pos + offset)
+
+        # 丢弃最后一个头部之前的内容，并把已拼接的部分折叠为一个元素，
+        # 让下一次拼接只需处理头部之后的内容和新增的chunk
+        cut = self.call_block_pos
+        if cut > 0:
+            active_text = active_text[cut:]
+            self.active_start += cut
+            self.scan_cursor -= cut
+            self.call_block_pos = 0
+            if self.fence_pos != -1:
+                self.fence_pos -= cut
+        active[:] = (active_text,)
+        return None
+
+    def detect(self, text: str) -> Optional[Tuple[str, int, int]]:
+        """
+        精确检测text中最后一个call_tool_code块内部的tool_code块。
+
+        同一轮中 text 只会不断增长，头部、开围栏和闭围栏都只在上次扫描位置之后查找。
+
+        Args:
+            text: 要检测的检测区域内容。
+
+        Returns:
+            如果成功找到，返回 (toolcode_content, start_pos, end_pos)，坐标相对于text
+        """
+        prev_len = self.scan_cursor
+        self.scan_cursor = len(text)
+
+        # 步骤 1: 使用 rfind() 高效、安全地定位最后一个 call_tool_code 块的头部
+        # 这避免了依赖一个可能尚未出现的终止标签。
+        header_pos = text.rfind(
+            _CALL_BLOCK_HEADER, max(0, prev_len - len(_CALL_BLOCK_HEADER) + 1)
+        )
+        if header_pos != -1:
+            # 出现了新的头部，之前找到的围栏不再属于最后一个块
+            self.call_block_pos = header_pos
+            self.fence_pos = -1
+        elif self.call_block_pos == -1:
+            # 如果没有找到任何 call_tool_code 块，直接返回
+            return None
+
+        # 步骤 2: 只在最后一个 call_tool_code 块之后查找第一个开围栏
+        if self.fence_pos == -1:
+            if header_pos != -1:
+                fence_search_start = header_pos
+            else:
+                fence_search_start = max(
+                    self.call_block_pos, prev_len - len(_TOOL_CODE_OPEN) + 1
+                )
+            fence_pos = text.find(_TOOL_CODE_OPEN, fence_search_start)
+            if fence_pos == -1:
+                return None
+            self.fence_pos = fence_pos
+            close_search_start = fence_pos + len(_TOOL_CODE_OPEN)
+        else:
+            fence_pos = self.fence_pos
+            close_search_start = max(
+                fence_pos + len(_TOOL_CODE_OPEN),
+                prev_len - len(_TOOL_CODE_CLOSE) + 1,
+            )
+
+        # 步骤 3: 在开围栏之后查找第一个闭围栏，即 ```tool_code\n(.*?)\n``` 的非贪婪匹配
+        close_pos = text.find(_TOOL_CODE_CLOSE, close_search_start)
+        if close_pos == -1:
+            return None
+
+        # 步骤 4: 返回 tool_code 内容及其坐标
+        return (
+            text[fence_pos + len(_TOOL_CODE_OPEN) : close_pos],
+            fence_pos,
+            close_pos + len(_TOOL_CODE_CLOSE),
+        )
+
+
+@dataclass(slots=True)
+class _StreamState:
+    """单次请求AI的流式状态，每轮循环重置字段而不是重新分配"""
+
+    parts: List[str] = field(default_factory=list)
+    cancellation: StreamCancellation = field(default_factory=StreamCancellation)
+    # 待转发给用户回调的chunk队列，未设置回调时为None
+    queue: "Optional[asyncio.Queue[Optional[str]]]" = None
+    scanner: _ToolCodeScanner = field(default_factory=_ToolCodeScanner)
+    toolcode_match: Optional[Tuple[str, int, int]] = None
+    # 输出超过 max_stream_output 后被取消
+    overflow: bool = False
+
+    def reset(self, queue) -> None:
+        """开始新一轮请求前重置状态，复用已分配的列表和取消令牌"""
+        self.parts.clear()
+        self.cancellation.cancelled = False
+        self.queue = queue
+        self.scanner.reset()
+        self.toolcode_match = None
+        self.overflow = False
 
 
 class AutoStreamProcessor:
@@ -36,6 +272,45 @@ class AutoStreamProcessor:
     支持 Gemini 原生 API 和 OpenAI 兼容 API
     """
 
+    # 服务端可能同时持有大量会话，使用__slots__去掉每个实例的__dict__
+    __slots__ = (
+        "api_key",
+        "default_api",
+        "_model",
+        "_system_prompt",
+        "temperature",
+        "max_tokens",
+        "top_p",
+        "top_k",
+        "timeout",
+        "api_delay",
+        "max_output_size",
+        "max_stream_output",
+        "api_type",
+        "base_url",
+        "presence_penalty",
+        "enable_multimodal",
+        "enable_context_cache",
+        "context_cache_ttl",
+        "context_cache_max_delta",
+        "max_history_messages",
+        "enable_response_cache",
+        "response_cache_size",
+        "response_cache_ttl",
+        "session",
+        "history",
+        "current_response",
+        "processing_complete",
+        "_stream_state",
+        "_turn_anchor",
+        "_context_cache",
+        "_cache_anchor",
+        "_cache_expires_at",
+        "_pending_cache_deletions",
+        "_response_cache",
+        "_tool_cache",
+    )
+
     def __init__(
         self,
         api_key: str,
@@ -49,10 +324,19 @@ class AutoStreamProcessor:
         timeout: float = 300.0,
         api_delay: float = 0.0,
         max_output_size: int = 65536,
+        max_stream_output: Optional[int] = None,
         api_type: APIType = APIType.GEMINI,
         base_url: str = "https://api.openai-hk.com/v1",
         presence_penalty: float = 0.0,
         enable_multimodal: bool = True,
+        enable_context_cache: bool = False,
+        context_cache_ttl: float = 600.0,
+        context_cache_max_delta: int = 16,
+        max_history_messages: Optional[int] = None,
+        enable_response_cache: bool = False,
+        response_cache_size: int = 128,
+        response_cache_ttl: float = 3600.0,
+        session: Optional["aiohttp.ClientSession"] = None,
     ):
         """
         初始化自动流式处理器
@@ -69,15 +353,27 @@ class AutoStreamProcessor:
             timeout: 请求超时时间
             api_delay: API调用后的延迟时间(秒),用于避免速率限制
             max_output_size: ToolCode执行时print输出的最大字节数限制
+            max_stream_output: 单次请求AI的流式输出最大字符数,超过后取消流式输出并报错,None表示不限制
             api_type: API类型, APIType.GEMINI 或 APIType.OPENAI
             base_url: OpenAI兼容API的基础URL (仅当api_type=APIType.OPENAI时使用)
             presence_penalty: 存在惩罚参数 (仅OpenAI使用)
             enable_multimodal: 是否启用多模态输入 (仅OpenAI兼容API使用, Gemini原生API默认支持)
+            enable_context_cache: 是否启用Gemini上下文缓存,缓存系统提示词和历史前缀,每轮只发送增量消息 (仅Gemini使用)
+            context_cache_ttl: 上下文缓存的有效期(秒)
+            context_cache_max_delta: 缓存前缀之后允许累积的最大消息数,超过后重建缓存
+            max_history_messages: 历史消息数上限,每轮用户消息开始时丢弃最旧的消息,None表示不限制
+            enable_response_cache: 是否启用响应缓存,系统提示词和对话历史完全相同时直接返回上次的响应,
+                不再请求AI也不再执行ToolCode (仅适用于工具无副作用的场景)。命中时按原顺序重放本轮
+                记录的回调事件(流式输出、ToolCode开始/结果等)，但不会调用 raw_response_callback
+            response_cache_size: 响应缓存的最大条目数
+            response_cache_ttl: 响应缓存的有效期(秒)
+            session: OpenAI兼容API请求使用的aiohttp会话,各轮ToolCode迭代和用户轮次复用其连接池,
+                由调用方负责关闭;None表示每次请求新建会话 (仅当api_type=APIType.OPENAI时使用)
         """
         self.api_key = api_key
         self.default_api = default_api
-        self.model = model
-        self.system_prompt = system_prompt
+        self._model = model
+        self._system_prompt = system_prompt
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.top_p = top_p
@@ -85,10 +381,19 @@ class AutoStreamProcessor:
         self.timeout = timeout
         self.api_delay = api_delay
         self.max_output_size = max_output_size
+        self.max_stream_output = max_stream_output
         self.api_type = api_type
         self.base_url = base_url
         self.presence_penalty = presence_penalty
         self.enable_multimodal = enable_multimodal
+        self.enable_context_cache = enable_context_cache
+        self.context_cache_ttl = context_cache_ttl
+        self.context_cache_max_delta = context_cache_max_delta
+        self.max_history_messages = max_history_messages
+        self.enable_response_cache = enable_response_cache
+        self.response_cache_size = response_cache_size
+        self.response_cache_ttl = response_cache_ttl
+        self.session = session
 
         # 对话历史
         self.history: List[ChatMessage] = []
@@ -97,6 +402,25 @@ class AutoStreamProcessor:
         self.current_response = ""
         self.processing_complete = False
 
+        # 流式输出及ToolCode检测状态，每次请求AI前重置
+        self._stream_state = _StreamState()
+
+        # 当前用户轮次的起始位置(即本轮用户消息在历史中的下标)
+        self._turn_anchor = 0
+
+        # Gemini上下文缓存状态: 缓存对象、缓存覆盖的历史消息数(-1表示尚未尝试)、过期时间
+        self._context_cache = None
+        self._cache_anchor = -1
+        self._cache_expires_at = 0.0
+        # 已失效、等待在下一次 _refresh_context_cache 或 aclose() 中删除的缓存
+        self._pending_cache_deletions: list = []
+
+        # 响应缓存: 键 -> (过期时间, 最终响应, 本轮追加到历史的消息, 本轮的回调事件)
+        self._response_cache: "OrderedDict[bytes, tuple]" = OrderedDict()
+
+        # ToolCode执行结果缓存: ToolCode源码摘要 -> 执行结果
+        self._tool_cache: "OrderedDict[bytes, List[dict]]" = OrderedDict()
+
     async def process_conversation(
         self,
         user_message: Union[str, ChatMessage],
@@ -123,49 +447,86 @@ class AutoStreamProcessor:
             完整的AI响应
         """
         if reset_history:
-            self.history.clear()
+            self.clear_history()
 
         # 处理不同类型的用户消息输入
         if isinstance(user_message, str):
             # 字符串消息：保持原有逻辑
             message_to_add = ChatMessage(
                 MessageRole.USER,
-                f"<reactAgentSegmentHeader>user_message</reactAgentSegmentHeader>{user_message}",
+                f"{_USER_MESSAGE_HEADER}{user_message}",
             )
         elif isinstance(user_message, ChatMessage):
             # ChatMessage对象：检查并调整格式
-            if user_message.role != MessageRole.USER:
+            if user_message.role is not MessageRole.USER:
                 raise ValueError("ChatMessage must have USER role")
 
             # 为ChatMessage添加header格式，保持与现有逻辑一致
             content = user_message.content
-            if not content.startswith(
-                "<reactAgentSegmentHeader>user_message</reactAgentSegmentHeader>"
-            ):
-                content = f"<reactAgentSegmentHeader>user_message</reactAgentSegmentHeader>{content}"
+            if not content.startswith(_USER_MESSAGE_HEADER):
+                content = f"{_USER_MESSAGE_HEADER}{content}"
 
             message_to_add = ChatMessage(
                 role=MessageRole.USER,
                 content=content,
-                media_files=getattr(user_message, "media_files", []),
+                media_files=user_message.media_files,
             )
         else:
             raise TypeError(
                 f"user_message must be str or ChatMessage, got {type(user_message)}"
             )
 
-        # 添加消息到历史
+        # 添加消息到历史，本轮的ToolCode迭代只会在其后追加消息
         self.history.append(message_to_add)
+        self._turn_anchor = len(self.history) - 1
+        self._trim_history()
 
         # 重置处理状态
         self.current_response = ""
         self.processing_complete = False
 
+        cache_key = self._response_cache_key() if self.enable_response_cache else None
+        if cache_key is not None:
+            cached = self._response_cache.get(cache_key)
+            if cached is not None and time.monotonic() < cached[0]:
+                # 命中缓存：重放本轮的历史消息，并按原顺序重放本轮的回调事件，
+                # 使回调看到的事件序列与未命中时一致 (raw_response_callback 不会被调用)
+                self._response_cache.move_to_end(cache_key)
+                _, final_response, turn_messages, events = cached
+                self.history.extend(turn_messages)
+                self.processing_complete = True
+                if callback:
+                    for payload, msg_type in events:
+                        await callback(payload, msg_type)
+                return final_response
+
+            # 记录本轮的回调事件，供之后命中缓存时重放
+            events = []
+            user_callback = callback
+
+            async def record_callback(payload, msg_type):
+                events.append((payload, msg_type))
+                if user_callback:
+                    await user_callback(payload, msg_type)
+
+            callback = record_callback
+
         # 开始处理循环 - 不再传递user_message
         final_response = await self._process_with_toolcode_loop(
             callback, max_cycle_cost, tool_code_timeout, raw_response_callback
         )
 
+        if cache_key is not None:
+            self._response_cache[cache_key] = (
+                time.monotonic() + self.response_cache_ttl,
+                final_response,
+                tuple(self.history[self._turn_anchor + 1 :]),
+                tuple(events),
+            )
+            self._response_cache.move_to_end(cache_key)
+            if len(self._response_cache) > self.response_cache_size:
+                self._response_cache.popitem(last=False)
+
         # 最终响应就是累积的AI输出，不需要重复添加到历史
         # 因为在处理过程中已经逐步更新了历史
 
@@ -189,35 +550,45 @@ class AutoStreamProcessor:
             callback(chunk: str, msg_type: CallbackMsgType)
         """
         final_response = ""
+        # final_response中是否已出现回复标记；只检查每次新追加的AI输出，避免反复扫描整个final_response
+        response_tag_seen = False
         cost = 0
-        while not self.processing_complete:
-            stream_buffer = ""
+        state = self._stream_state
+        stream_parts = state.parts
+        cancellation_token = state.cancellation
+        # 绑定一次，避免每轮循环重新创建闭包
+        stream_callback = self._on_stream_chunk
+        while True:
             if cost > max_cycle_cost:
                 raise RuntimeError(
                     f"Agent processing exceeded maximum cycle cost of {max_cycle_cost}."
                 )
             cost += 1
 
-            cancellation_token = StreamCancellation()
-
-            async def stream_callback(chunk: str):
-                nonlocal stream_buffer
-                stream_buffer += chunk
-                if callback:
-                    await callback(chunk, CallbackMsgType.STREAM)
-                # 检查是否出现了ToolCode块
-                toolcode_match = self._detect_toolcode_in_call_block(stream_buffer)
-                if toolcode_match:
-                    cancellation_token.cancel()  # 取消流式输出
+            # 用户回调在独立任务中消费，慢回调(如UI刷新)不会阻塞从上游读取token
+            drain_task = None
+            queue = None
+            if callback:
+                queue = asyncio.Queue(maxsize=_STREAM_QUEUE_SIZE)
+                drain_task = asyncio.create_task(
+                    self._drain_stream_callbacks(queue, callback)
+                )
+            state.reset(queue)
 
             # 基于当前历史请求AI
             try:
                 if self.api_type == APIType.GEMINI:
                     # 使用 Gemini 原生 API
+                    history = self.history
+                    if self.enable_context_cache:
+                        await self._refresh_context_cache()
+                        if self._context_cache is not None:
+                            # 缓存中已包含系统提示词和历史前缀，只发送增量消息
+                            history = self.history[self._cache_anchor :]
                     await stream_chat(
                         api_key=self.api_key,
                         callback=stream_callback,
-                        history=self.history.copy(),
+                        history=history,
                         model=self.model,
                         system_prompt=self.system_prompt,
                         temperature=self.temperature,
@@ -227,13 +598,14 @@ class AutoStreamProcessor:
                         cancellation_token=cancellation_token,
                         timeout=self.timeout,
                         raw_response_callback=raw_response_callback,
+                        cached_content=self._context_cache,
                     )
                 elif self.api_type == APIType.OPENAI:
                     # 使用 OpenAI 兼容 API
                     await stream_chat_openai(
                         api_key=self.api_key,
                         callback=stream_callback,
-                        history=self.history.copy(),
+                        history=self.history,
                         model=self.model,
                         system_prompt=self.system_prompt,
                         temperature=self.temperature,
@@ -245,10 +617,16 @@ class AutoStreamProcessor:
                         timeout=self.timeout,
                         enable_multimodal=self.enable_multimodal,
                         raw_response_callback=raw_response_callback,
+                        session=self.session,
                     )
                 else:
                     raise ValueError(f"Unsupported api_type: {self.api_type}")
 
+                # 等待所有流式回调完成，保证其先于后续的ToolCode回调
+                if drain_task is not None:
+                    await queue.put(None)
+                    await drain_task
+
                 # 添加API调用后的延迟,避免速率限制
                 if self.api_delay > 0:
                     await asyncio.sleep(self.api_delay)
@@ -256,83 +634,86 @@ class AutoStreamProcessor:
             except Exception as e:
                 # stream_chat的异常直接抛出
                 raise e
+            finally:
+                if drain_task is not None and not drain_task.done():
+                    drain_task.cancel()
 
-            if stream_buffer == "":
+            if state.overflow:
+                raise RuntimeError(
+                    "AI output exceeded maximum stream output of "
+                    f"{self.max_stream_output} characters."
+                )
+            if not stream_parts:
                 continue  # 如果没有任何输出，继续循环
-            ai_output = stream_buffer
-            # 检查AI输出中是否有ToolCode
-            toolcode_match = self._detect_toolcode_in_call_block(ai_output)
+            ai_output = "".join(stream_parts)
+            toolcode_match = state.toolcode_match
+            # 流式回调中已完成ToolCode检测，闭合围栏之后的内容会被截断
             if toolcode_match:
                 toolcode_content, start_pos, end_pos = toolcode_match
                 before_toolcode = ai_output[:start_pos]
                 final_response += before_toolcode
+                if not response_tag_seen:
+                    response_tag_seen = _SEND_RESPONSE_TAG in before_toolcode
                 final_response += f"```tool_code\n{toolcode_content}\n```\n"
 
-                async def handle_toolcode_result(result_text, is_error=False):
-                    fake_result = f"<reactAgentSegmentHeader>system_feedback</reactAgentSegmentHeader>\nTool Result:\n{result_text}"
-                    if cost >= max_cycle_cost:
-                        fake_result += "<reactAgentSegmentHeader>system_feedback</reactAgentSegmentHeader>\nYOU HAVE REACHED THE MAXIMUM ITERATION COST. OUTPUT YOUR FINAL RESPONSE NOW."
-                    self.history.append(
-                        ChatMessage(
-                            MessageRole.ASSISTANT,
-                            before_toolcode
-                            + "```tool_code\n"
-                            + toolcode_content
-                            + "\n```"
-                            + fake_result,
+                # 工具无副作用时，相同的ToolCode直接复用上一次的执行结果
+                tool_cache_key = None
+                execution_results = None
+                if self.default_api.cacheable:
+                    tool_cache_key = hashlib.blake2b(
+                        toolcode_content.encode(), digest_size=16
+                    ).digest()
+                    execution_results = self._tool_cache.get(tool_cache_key)
+
+                # 立即开始执行ToolCode，与TOOLCODE_START回调并发进行
+                eval_task = None
+                if execution_results is None:
+                    eval_task = asyncio.create_task(
+                        eval_tool_code(
+                            toolcode_content,
+                            self.default_api,
+                            timeout=tool_code_timeout,
+                            max_output_size=self.max_output_size,
                         )
                     )
-                    self.history.append(
-                        ChatMessage(
-                            MessageRole.USER,
-                            f"<reactAgentSegmentHeader>system_feedback</reactAgentSegmentHeader>\ncontinue ReAct processing by using `<reactAgentSegmentHeader>think</reactAgentSegmentHeader>`",
-                        )
-                    )
-                    nonlocal final_response
-                    final_response += fake_result
-                    if callback:
-                        cb_type = (
-                            CallbackMsgType.ERROR
-                            if is_error
-                            else CallbackMsgType.TOOLCODE_RESULT
-                        )
-                        await callback(result_text, cb_type)
-
+                else:
+                    self._tool_cache.move_to_end(tool_cache_key)
                 try:
                     if callback:
                         await callback(toolcode_content, CallbackMsgType.TOOLCODE_START)
-                    execution_results = await eval_tool_code(
-                        toolcode_content,
-                        self.default_api,
-                        timeout=tool_code_timeout,
-                        max_output_size=self.max_output_size,
-                    )
+                    if eval_task is not None:
+                        execution_results = await eval_task
+                        if tool_cache_key is not None:
+                            self._cache_tool_results(tool_cache_key, execution_results)
                     result_text = self._format_execution_results(execution_results)
-                    await handle_toolcode_result(result_text, is_error=False)
+                    result_type = CallbackMsgType.TOOLCODE_RESULT
                 except Exception as e:
-                    await handle_toolcode_result(str(e), is_error=True)
+                    if eval_task is not None:
+                        eval_task.cancel()
+                    result_text = str(e)
+                    result_type = CallbackMsgType.ERROR
+
+                final_response += self._record_tool_result(
+                    before_toolcode,
+                    toolcode_content,
+                    result_text,
+                    max_iteration_reached=cost >= max_cycle_cost,
+                )
+                if callback:
+                    await callback(result_text, result_type)
                 # 继续循环
                 continue
             else:
                 # 没有ToolCode，处理完成
                 final_response += ai_output
                 # 检查是否存在 `<reactAgentSegmentHeader>send_response_to_user</reactAgentSegmentHeader>`标记，如果final_response中不存在回复的内容，则继续
-                if (
-                    "<reactAgentSegmentHeader>send_response_to_user</reactAgentSegmentHeader>"
-                    not in final_response
-                ):
-                    self.history.append(
-                        ChatMessage(
-                            MessageRole.ASSISTANT,
-                            ai_output,
-                        )
-                    )
+                if not response_tag_seen:
+                    response_tag_seen = _SEND_RESPONSE_TAG in ai_output
+                if not response_tag_seen:
                     # 模拟系统消息，提示AI必须输出`<reactAgentSegmentHeader>send_response_to_user</reactAgentSegmentHeader>`标记
-                    self.history.append(
-                        ChatMessage(
-                            MessageRole.USER,
-                            f"<reactAgentSegmentHeader>system_alert</reactAgentSegmentHeader>\nNo `<reactAgentSegmentHeader>send_response_to_user</reactAgentSegmentHeader>` tag detected in the response. This response is invalid. Please ensure your final response includes the `<reactAgentSegmentHeader>send_response_to_user</reactAgentSegmentHeader>` tag and try again.",
-                        )
+                    self._append_turn(
+                        ai_output,
+                        _MISSING_RESPONSE_TAG_ALERT,
                     )
                     if callback:
                         await callback(
@@ -340,56 +721,263 @@ class AutoStreamProcessor:
                         )
                     continue
                 self.processing_complete = True
-                self.history.append(ChatMessage(MessageRole.ASSISTANT, ai_output))
+                self._append_turn(ai_output)
+                break
         return final_response
 
-    def _detect_toolcode_in_call_block(
-        self, text: str
-    ) -> Optional[Tuple[str, int, int]]:
+    async def _on_stream_chunk(self, chunk: str):
+        """流式回调：缓冲chunk、转发给用户回调，并检测ToolCode块"""
+        state = self._stream_state
+        # 已检测到ToolCode并取消，丢弃上游在停止前仍在途的chunk，
+        # 既不缓冲也不回调，toolcode_match保持为第一次检测的结果
+        if state.cancellation.cancelled:
+            return
+        state.parts.append(chunk)
+        queue = state.queue
+        if queue is not None:
+            try:
+                queue.put_nowait(chunk)
+            except asyncio.QueueFull:
+                await queue.put(chunk)
+        # 检查是否出现了ToolCode块，出现后立即取消流式输出并开始执行
+        scanner = state.scanner
+        toolcode_match = scanner.feed(chunk)
+        if toolcode_match:
+            state.toolcode_match = toolcode_match
+            state.cancellation.cancel()
+        elif (
+            self.max_stream_output is not None
+            and scanner.length > self.max_stream_output
+        ):
+            # 失控的输出(如始终不闭合的ToolCode块)继续缓冲没有意义，直接停止读取
+            state.overflow = True
+            state.cancellation.cancel()
+
+    async def _drain_stream_callbacks(
+        self,
+        queue: "asyncio.Queue[Optional[str]]",
+        callback: Callable[[str | Exception, "CallbackMsgType"], Awaitable[None]],
+    ) -> None:
+        """
+        把队列中的chunk转发给用户回调，收到None时结束
+
+        上一次回调执行期间积压的chunk会合并为一次回调，高吞吐时减少回调次数，
+        而上游没有积压时每个chunk仍会立即转发，不引入额外延迟。
+        回调抛出异常时取消流式输出，并继续取出剩余的chunk(不再回调)，
+        避免上游在队列已满时永久阻塞，异常在结束时重新抛出。
         """
-        精确检测AI输出中最后一个call_tool_code块内部的tool_code块。
+        error = None
+        done = False
+        while not done:
+            batch = [await queue.get()]
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            if error is not None or not batch:
+                continue
+            try:
+                await callback("".join(batch), CallbackMsgType.STREAM)
+            except Exception as e:
+                error = e
+                self._stream_state.cancellation.cancel()
+        if error is not None:
+            raise error
+
+    def _cache_tool_results(self, key: bytes, execution_results: List[dict]) -> None:
+        """写入ToolCode执行结果缓存，超出容量时淘汰最久未使用的条目"""
+        self._tool_cache[key] = execution_results
+        if len(self._tool_cache) > _TOOL_CACHE_SIZE:
+            self._tool_cache.popitem(last=False)
+
+    def _record_tool_result(
+        self,
+        before_toolcode: str,
+        toolcode_content: str,
+        result_text: str,
+        max_iteration_reached: bool = False,
+    ) -> str:
+        """
+        用assistant消息伪造ToolCode的返回值并写入历史
 
         Args:
-            text: 要检测的完整AI流式输出。
+            before_toolcode: ToolCode块之前的AI输出
+            toolcode_content: ToolCode代码内容
+            result_text: 执行结果或错误信息
+            max_iteration_reached: 是否已达到最大循环次数，是则提示AI立即输出最终回复
 
         Returns:
-            如果成功找到，返回 (toolcode_content, start_pos, end_pos)
+            伪造的系统反馈内容，由调用方追加到最终响应中
         """
-        # 步骤 1: 使用 rfind() 高效、安全地定位最后一个 call_tool_code 块的头部
-        # 这避免了依赖一个可能尚未出现的终止标签。
-        call_block_header = (
-            "<reactAgentSegmentHeader>call_tool_code</reactAgentSegmentHeader>"
+        fake_result = _TOOL_RESULT_PREFIX + result_text
+        if max_iteration_reached:
+            fake_result += _MAX_ITERATION_SUFFIX
+        self._append_turn(
+            "".join(
+                (
+                    before_toolcode,
+                    _TOOL_CODE_OPEN,
+                    toolcode_content,
+                    _TOOL_CODE_CLOSE,
+                    fake_result,
+                )
+            ),
+            _CONTINUE_FEEDBACK,
         )
-        last_call_block_start_pos = text.rfind(call_block_header)
+        return fake_result
 
-        # 如果没有找到任何 call_tool_code 块，直接返回
-        if last_call_block_start_pos == -1:
-            return None
+    def _append_turn(
+        self, assistant_content: str, user_feedback: Optional[str] = None
+    ) -> None:
+        """
+        向历史追加一条assistant消息，以及可选的系统反馈(以user角色发送)
+
+        Args:
+            assistant_content: assistant消息内容
+            user_feedback: 紧随其后的反馈消息内容，为None时不追加
+        """
+        history = self.history
+        history.append(ChatMessage(MessageRole.ASSISTANT, assistant_content))
+        if user_feedback is not None:
+            history.append(ChatMessage(MessageRole.USER, user_feedback))
 
-        # 步骤 2: 只在最后一个 call_tool_code 块之后的内容中进行搜索
-        # 这就是我们的有效搜索区域
-        search_region_text = text[last_call_block_start_pos:]
+    def _response_cache_key(self) -> Optional[bytes]:
+        """
+        根据模型、系统提示词和当前对话历史计算响应缓存的键
 
-        # 定义用于匹配 ```tool_code...``` 的正则表达式
-        tool_code_pattern = re.compile(
-            r"```tool_code\n(.*?)\n```", re.DOTALL | re.MULTILINE
-        )
+        Returns:
+            缓存键；历史中包含媒体文件时返回None，不使用缓存
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{self.api_type.value}\0{self.model}\0".encode())
+        digest.update((self.system_prompt or "").encode())
+        for message in self.history:
+            if message.media_files:
+                return None
+            content = message.content.encode()
+            # 带上长度，避免内容中的分隔符造成不同历史的键相同
+            digest.update(f"\0{message.role.value}\0{len(content)}\0".encode())
+            digest.update(content)
+        return digest.digest()
+
+    def _trim_history(self) -> None:
+        """
+        历史超过 max_history_messages 时丢弃最旧的消息
 
-        # 在限定的区域内搜索 tool_code
-        tool_code_match = tool_code_pattern.search(search_region_text)
+        只在每轮用户消息开始时调用：本轮的用户消息永远不会被丢弃，
+        且保留下来的历史总是从一条真正的用户消息(而非系统反馈)开始。同一轮内的ToolCode迭代
+        不做裁剪，避免每次迭代都改变历史前缀、使上下文缓存失效。
+        """
+        limit = self.max_history_messages
+        history = self.history
+        if limit is None or len(history) <= limit:
+            return
+
+        anchor = self._turn_anchor
+        drop = min(len(history) - limit, anchor)
+        # 跳到真正的用户消息；系统反馈、ToolCode返回值等同样以user角色发送，不能作为起点
+        while drop < anchor and not history[drop].content.startswith(
+            _USER_MESSAGE_HEADER
+        ):
+            drop += 1
+        if drop <= 0:
+            return
+
+        del history[:drop]
+        self._turn_anchor = anchor - drop
+        self._invalidate_context_cache()
+
+    async def _refresh_context_cache(self) -> None:
+        """
+        按需创建或重建Gemini上下文缓存
 
-        # 如果在限定区域内没有找到 tool_code，返回 None
-        if not tool_code_match:
-            return None
+        缓存覆盖当前用户轮次之前的稳定历史前缀，因此同一轮内的ToolCode迭代
+        不会触发重建，只在新的一轮开始时检查。缓存未创建、即将过期、
+        或前缀之后累积的消息数超过 context_cache_max_delta 时重建。
+        创建失败(如前缀短于模型的最小缓存token数)时退化为发送完整历史，
+        并在累积足够多的新消息后再重试。开始前先删除已失效的缓存。
+        """
+        # 删除失败不影响本轮对话，失败的缓存等待其自然过期
+        await self._delete_pending_context_caches()
+
+        anchor = self._turn_anchor
+        if (
+            self._cache_anchor >= 0
+            and anchor - self._cache_anchor <= self.context_cache_max_delta
+            and (
+                self._context_cache is None
+                or time.monotonic() < self._cache_expires_at
+            )
+        ):
+            return
+
+        old_cache = self._context_cache
+        self._context_cache = None
+        self._cache_anchor = anchor
+        try:
+            self._context_cache = await create_context_cache(
+                api_key=self.api_key,
+                history=self.history[:anchor],
+                model=self.model,
+                system_prompt=self.system_prompt,
+                ttl=self.context_cache_ttl,
+            )
+            # 预留余量，避免缓存在请求过程中过期
+            self._cache_expires_at = time.monotonic() + self.context_cache_ttl * 0.8
+        except ValueError:
+            pass
 
-        # 步骤 3: 计算并返回全局坐标
-        toolcode_content = tool_code_match.group(1)
+        if old_cache is not None:
+            try:
+                await delete_context_cache(old_cache)
+            except ValueError:
+                pass  # 删除失败时等待缓存自然过期
 
-        # tool_code 的全局起始位置 = call_tool_code头的起始位置 + tool_code在搜索区域内的起始位置
-        global_start_pos = last_call_block_start_pos + tool_code_match.start()
-        global_end_pos = last_call_block_start_pos + tool_code_match.end()
+    def _invalidate_context_cache(self) -> None:
+        """
+        历史、系统提示词或模型改变后，缓存的前缀不再有效
+
+        旧缓存在服务端按存储时长计费，因此记入待删除列表，在下一次
+        _refresh_context_cache 或 aclose() 中删除，而不是等待其过期。
+        """
+        old_cache = self._context_cache
+        self._context_cache = None
+        self._cache_anchor = -1
+        if old_cache is not None:
+            self._pending_cache_deletions.append(old_cache)
 
-        return (toolcode_content, global_start_pos, global_end_pos)
+    async def _delete_pending_context_caches(self) -> List[BaseException]:
+        """
+        删除所有已失效的上下文缓存
+
+        Returns:
+            删除失败的异常列表，失败的缓存只能等待其自然过期
+        """
+        pending = self._pending_cache_deletions
+        if not pending:
+            return []
+        self._pending_cache_deletions = []
+        results = await asyncio.gather(
+            *(delete_context_cache(cache) for cache in pending),
+            return_exceptions=True,
+        )
+        return [result for result in results if isinstance(result, BaseException)]
+
+    async def aclose(self) -> None:
+        """
+        删除处理器在服务端创建的上下文缓存
+
+        不再使用处理器时调用，确保缓存立即停止计费而不是等待其过期。
+        之后仍可继续使用处理器，需要时会重新创建缓存。
+
+        Raises:
+            ValueError: 有缓存删除失败时抛出第一个错误(其余缓存仍会尝试删除)
+        """
+        self._invalidate_context_cache()
+        errors = await self._delete_pending_context_caches()
+        if errors:
+            raise errors[0]
 
     def _format_execution_results(self, results: List[dict]) -> str:
         """
@@ -404,13 +992,13 @@ class AutoStreamProcessor:
         if not results:
             return "[无执行结果]"
 
-        formatted_results = []
-        for result in results:
-            args = result.get("args", ())
-            if args:
-                # 将每个参数转换为字符串并收集
-                for arg in args:
-                    formatted_results.append(str(arg))
+        # 将所有print调用的每个参数转换为字符串，一次性拼接；args缺失或为None时跳过
+        # 参数绝大多数已是str，用类型恒等判断跳过多余的str()调用
+        formatted_results = [
+            arg if type(arg) is str else str(arg)
+            for result in results
+            for arg in result.get("args") or ()
+        ]
 
         return "\n".join(formatted_results) if formatted_results else "[Invalid result]"
 
@@ -422,19 +1010,51 @@ class AutoStreamProcessor:
             history: ChatMessage列表
         """
         self.history = history.copy()
+        self._invalidate_context_cache()
 
     def get_history(self) -> List[ChatMessage]:
         """获取完整的对话历史"""
         return self.history.copy()
 
+    def get_history_view(self) -> Sequence[ChatMessage]:
+        """
+        获取对话历史的只读视图，不复制列表
+
+        返回的是处理器内部的历史本身，调用方不得修改；后续对话会继续在其后追加消息。
+        需要独立副本时请使用 get_history()。
+        """
+        return self.history
+
     def clear_history(self):
         """清空对话历史"""
         self.history.clear()
+        self._invalidate_context_cache()
 
     def set_system_prompt(self, prompt: str):
         """设置系统提示词"""
         self.system_prompt = prompt
 
+    # 上下文缓存包含创建时的系统提示词并绑定创建时的模型，二者改变后缓存即失效
+    @property
+    def system_prompt(self) -> Optional[str]:
+        """系统提示词"""
+        return self._system_prompt
+
+    @system_prompt.setter
+    def system_prompt(self, prompt: Optional[str]) -> None:
+        self._system_prompt = prompt
+        self._invalidate_context_cache()
+
+    @property
+    def model(self) -> str:
+        """使用的模型名称"""
+        return self._model
+
+    @model.setter
+    def model(self, model: str) -> None:
+        self._model = model
+        self._invalidate_context_cache()
+
     def create_user_message(
         self, content: str, media_files: Optional[List] = None
     ) -> ChatMessage:
@@ -448,15 +1068,9 @@ class AutoStreamProcessor:
         Returns:
             ChatMessage对象
         """
-        from .gemini_chat import MediaFile
-
         message = ChatMessage(role=MessageRole.USER, content=content)
 
         if media_files:
-            # 确保media_files属性存在
-            if not hasattr(message, "media_files"):
-                message.media_files = []
-
             for media_item in media_files:
                 if isinstance(media_item, str):
                     # 文件路径
@@ -502,6 +1116,39 @@ This ensures the output can be displayed correctly in a web view AND be easily c
 """
 
 
+# COT系统提示词缓存：同一组工具创建多个处理器时(如每个请求一个会话)复用同一个提示词字符串
+_COT_PROMPT_CACHE: "OrderedDict[tuple, str]" = OrderedDict()
+_COT_PROMPT_CACHE_SIZE = 32
+
+
+def _cached_cot_template(
+    tool_codes: List[ToolCodeInfo],
+    character_description: str,
+    respond_tags_description: str,
+) -> str:
+    """带LRU缓存的cot_template"""
+    # args用repr作为键，避免1与True这类相等但渲染结果不同的值互相冲突
+    key = (
+        tuple(
+            (tc.name, tc.description, tc.detail, repr(tc.args)) for tc in tool_codes
+        ),
+        character_description,
+        respond_tags_description,
+    )
+    system_prompt = _COT_PROMPT_CACHE.get(key)
+    if system_prompt is not None:
+        _COT_PROMPT_CACHE.move_to_end(key)
+        return system_prompt
+
+    system_prompt = cot_template(
+        tool_codes, character_description, respond_tags_description
+    )
+    _COT_PROMPT_CACHE[key] = system_prompt
+    if len(_COT_PROMPT_CACHE) > _COT_PROMPT_CACHE_SIZE:
+        _COT_PROMPT_CACHE.popitem(last=False)
+    return system_prompt
+
+
 # 便利函数：创建带有COT模板的处理器
 def create_cot_processor(
     api_key: str,
@@ -526,7 +1173,7 @@ def create_cot_processor(
         配置好的AutoStreamProcessor实例
     """
     # 生成COT系统提示词
-    system_prompt = cot_template(
+    system_prompt = _cached_cot_template(
         tool_codes, character_description, respond_tags_description
     )
 
@@ -5,21 +5,43 @@ Also supports OpenAI-compatible API format for third-party relay services.
 """
 
 import asyncio
-import base64
+import binascii
+import contextlib
+import datetime
+import functools
 import mimetypes
 import os
 import json
+import re
+import weakref
 from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
-from typing import Optional, Awaitable, Callable
+from typing import Optional, Awaitable, Callable, NoReturn, Sequence
 
 import google.generativeai as genai
+from google.generativeai import caching
 from google.generativeai.types import GenerationConfig, HarmCategory, HarmBlockThreshold
 from google.api_core import exceptions as google_exceptions
+from google.api_core import grpc_helpers_async
 
 from .template import BRIEF_PROMPT
 
+try:
+    # Optional dependency: orjson parses the raw SSE payload bytes and encodes
+    # request bodies several times faster than the stdlib; its JSONDecodeError
+    # subclasses json's
+    import orjson
+
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        """Encode obj as compact UTF-8 JSON, like orjson.dumps."""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
 
 class MessageRole(Enum):
     """Message roles for chat completion."""
@@ -37,44 +59,47 @@ class MediaType(Enum):
     DOCUMENT = "document"
 
 
+# Magic bytes of the recognised formats, grouped by their first two bytes so
+# that detection is one dict lookup plus the few startswith checks of a group.
+# Within a group, entries are tried in order.
+_MAGIC_BYTES = {
+    b"\xff\xd8": ((b"\xff\xd8\xff", "image/jpeg"),),
+    b"\x89P": ((b"\x89PNG\r\n\x1a\n", "image/png"),),
+    b"GI": ((b"GIF8", "image/gif"),),
+    b"\x00\x00": (
+        (b"\x00\x00\x00\x18ftypheic", "image/heic"),
+        (b"\x00\x00\x00\x1cftypmif1", "image/heic"),
+        (b"\x00\x00\x00\x18ftyp", "video/mp4"),
+        (b"\x00\x00\x00\x20ftyp", "video/mp4"),
+    ),
+    b"ID": ((b"ID3", "audio/mp3"),),
+    b"\xff\xfb": ((b"\xff\xfb", "audio/mp3"),),
+    b"fL": ((b"fLaC", "audio/flac"),),
+    b"%P": ((b"%PDF", "application/pdf"),),
+}
+
+# RIFF containers are told apart by the form type within the first 12 bytes
+_RIFF_FORMATS = (
+    (b"WEBP", "image/webp"),
+    (b"AVI ", "video/avi"),
+    (b"WAVE", "audio/wav"),
+)
+
+
 def _detect_mime_type_from_data(data: bytes) -> Optional[str]:
     """Detect MIME type from file data using magic bytes."""
     if not data:
         return None
 
-    # Check common image formats
-    if data.startswith(b"\xff\xd8\xff"):
-        return "image/jpeg"
-    elif data.startswith(b"\x89PNG\r\n\x1a\n"):
-        return "image/png"
-    elif data.startswith(b"GIF8"):
-        return "image/gif"
-    elif data.startswith(b"RIFF") and b"WEBP" in data[:12]:
-        return "image/webp"
-    elif data.startswith(b"\x00\x00\x00\x18ftypheic") or data.startswith(
-        b"\x00\x00\x00\x1cftypmif1"
-    ):
-        return "image/heic"
-
-    # Check common video formats
-    elif data.startswith(b"\x00\x00\x00\x18ftyp") or data.startswith(
-        b"\x00\x00\x00\x20ftyp"
-    ):
-        return "video/mp4"
-    elif data.startswith(b"RIFF") and b"AVI " in data[:12]:
-        return "video/avi"
-
-    # Check common audio formats
-    elif data.startswith(b"ID3") or data.startswith(b"\xff\xfb"):
-        return "audio/mp3"
-    elif data.startswith(b"RIFF") and b"WAVE" in data[:12]:
-        return "audio/wav"
-    elif data.startswith(b"fLaC"):
-        return "audio/flac"
-
-    # Check PDF
-    elif data.startswith(b"%PDF"):
-        return "application/pdf"
+    if data.startswith(b"RIFF"):
+        header = data[:12]
+        for form_type, mime_type in _RIFF_FORMATS:
+            if form_type in header:
+                return mime_type
+    else:
+        for magic, mime_type in _MAGIC_BYTES.get(data[:2], ()):
+            if data.startswith(magic):
+                return mime_type
 
     # Default to binary if unknown
     return "application/octet-stream"
@@ -92,9 +117,9 @@ def _get_media_type_from_mime(mime_type: str) -> MediaType:
         return MediaType.DOCUMENT
 
 
-def _is_supported_media_type(mime_type: str) -> bool:
-    """Check if the MIME type is supported by Gemini API."""
-    supported_types = {
+# MIME types accepted by the Gemini API for inline media
+_SUPPORTED_MIME_TYPES = frozenset(
+    {
         # Images
         "image/png",
         "image/jpeg",
@@ -122,11 +147,20 @@ def _is_supported_media_type(mime_type: str) -> bool:
         "application/pdf",
         "text/plain",
     }
-    return mime_type in supported_types
+)
+
+
+def _is_supported_media_type(mime_type: str) -> bool:
+    """Check if the MIME type is supported by Gemini API."""
+    return mime_type in _SUPPORTED_MIME_TYPES
+
+
+# Largest media file accepted as inline data, in bytes
+_MAX_MEDIA_FILE_SIZE = 20 * 1024 * 1024
 
 
 def _validate_media_file(
-    media_file: "MediaFile", max_file_size: int = 20 * 1024 * 1024
+    media_file: "MediaFile", max_file_size: int = _MAX_MEDIA_FILE_SIZE
 ) -> None:
     """Validate media file size and format."""
     if not media_file.data:
@@ -150,11 +184,21 @@ def _prepare_media_for_api(media_file: "MediaFile") -> dict:
 
     return {
         "mime_type": media_file.mime_type,
-        "data": base64.b64encode(media_file.data).decode("utf-8"),
+        "data": _media_base64(media_file),
     }
 
 
-@dataclass
+def _media_base64(media_file: "MediaFile") -> str:
+    """Base64-encode the media data, reusing the result while the data is unchanged."""
+    cached = media_file._b64
+    if cached is not None and cached[0] is media_file.data:
+        return cached[1]
+    encoded = binascii.b2a_base64(media_file.data, newline=False).decode("ascii")
+    media_file._b64 = (media_file.data, encoded)
+    return encoded
+
+
+@dataclass(slots=True)
 class MediaFile:
     """Represents a media file for multimodal input."""
 
@@ -162,6 +206,9 @@ class MediaFile:
     data: Optional[bytes] = None
     mime_type: Optional[str] = None
     media_type: Optional[MediaType] = None
+    # (data, base64 of data), so every request in a conversation encodes the
+    # same bytes only once (see _media_base64)
+    _b64: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self):
         """Validate and infer media type and MIME type."""
@@ -171,8 +218,17 @@ class MediaFile:
         if self.file_path and not self.data:
             # Read file data
             path = Path(self.file_path)
-            if not path.exists():
-                raise FileNotFoundError(f"File not found: {self.file_path}")
+            try:
+                size = path.stat().st_size
+            except (FileNotFoundError, NotADirectoryError):
+                raise FileNotFoundError(f"File not found: {self.file_path}") from None
+
+            # Reject oversized files before reading them into memory
+            if size > _MAX_MEDIA_FILE_SIZE:
+                raise ValueError(
+                    f"File size {size} bytes exceeds maximum "
+                    f"{_MAX_MEDIA_FILE_SIZE} bytes"
+                )
 
             self.data = path.read_bytes()
 
@@ -190,13 +246,18 @@ class MediaFile:
             self.media_type = _get_media_type_from_mime(self.mime_type)
 
 
-@dataclass
+@dataclass(slots=True)
 class ChatMessage:
     """Chat message that can contain text and media files."""
 
     role: MessageRole
     content: str
     media_files: list[MediaFile] = field(default_factory=list)
+    # Encoded API form of this message, reused across requests while the
+    # content and media files are unchanged (see _cached_encoding)
+    _encoded: Optional[tuple] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     def add_media_file(
         self,
@@ -224,32 +285,370 @@ class StreamCancellation:
         return self.cancelled
 
 
-def _process_reasoning_content(text: str, model: str) -> str:
-    """Process reasoning model content, filtering out <thought> tag content."""
-    if "thinking" not in model:
-        return text
-
-    result = ""
-    in_thought = False
-    i = 0
-    while i < len(text):
-        if text[i : i + 9] == "<thought>":
-            in_thought = True
-            i += 9
-        elif text[i : i + 10] == "</thought>":
-            in_thought = False
-            i += 10
+async def _load_media_files(
+    media_items: Sequence[str | MediaFile],
+) -> list[MediaFile]:
+    """Resolve file paths and MediaFile objects; files are read off the event loop."""
+    media_files = []
+    for media_item in media_items:
+        if isinstance(media_item, str):
+            media_item = await asyncio.to_thread(MediaFile, file_path=media_item)
+        elif not isinstance(media_item, MediaFile):
+            raise ValueError(f"Invalid media item type: {type(media_item)}")
+        media_files.append(media_item)
+    return media_files
+
+
+# Either thought tag; the filter tracks whether it is inside a block itself
+_THOUGHT_TAG_RE = re.compile(r"</?thought>")
+
+
+class _ThoughtFilter:
+    """
+    Streaming filter that removes <thought> blocks from reasoning model output.
+
+    State is kept across chunks, so a block or a tag split over several chunks
+    is still filtered, and each chunk is scanned only once. Stray closing tags
+    are dropped and an unclosed <thought> hides the rest of the output.
+    """
+
+    __slots__ = ("in_thought", "tail")
+
+    def __init__(self):
+        self.in_thought = False
+        # Trailing text that may be the start of a tag, held until the next chunk
+        self.tail = ""
+
+    def feed(self, text: str) -> str:
+        """Filter the next chunk and return the text that is safe to emit."""
+        if self.tail:
+            text = self.tail + text
+            self.tail = ""
+        parts = []
+        pos = 0
+        while True:
+            if self.in_thought:
+                end = text.find("</thought>", pos)
+                if end == -1:
+                    self.tail = text[self._partial_tag_start(text, pos) :]
+                    break
+                pos = end + 10
+                self.in_thought = False
+            else:
+                match = _THOUGHT_TAG_RE.search(text, pos)
+                if match is None:
+                    keep = self._partial_tag_start(text, pos)
+                    parts.append(text[pos:keep])
+                    self.tail = text[keep:]
+                    break
+                parts.append(text[pos : match.start()])
+                pos = match.end()
+                self.in_thought = pos - match.start() == 9
+        return "".join(parts)
+
+    def flush(self) -> str:
+        """Return held text that turned out not to be a tag once the stream ends."""
+        tail = "" if self.in_thought else self.tail
+        self.tail = ""
+        return tail
+
+    @staticmethod
+    def _partial_tag_start(text: str, pos: int) -> int:
+        """Index where a possibly incomplete trailing tag starts, else len(text)."""
+        start = text.rfind("<", max(pos, len(text) - 9))
+        if start != -1:
+            partial = text[start:]
+            if "</thought>".startswith(partial) or "<thought>".startswith(partial):
+                return start
+        return len(text)
+
+
+class _StallWatchdog:
+    """
+    Cancel the reading task when a stream delivers no chunk for `timeout` seconds.
+
+    asyncio.wait_for wraps every awaited chunk in a new Task before Python 3.12.
+    The watchdog keeps a single timer per stream instead: receiving a chunk only
+    moves the deadline, and the timer re-arms itself when it fires early.
+    """
+
+    __slots__ = ("_loop", "_task", "_timeout", "_deadline", "_handle", "stalled")
+
+    def __init__(self, timeout: float):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        self._timeout = timeout
+        # None while a received chunk is being processed (callbacks are not timed)
+        self._deadline: Optional[float] = self._loop.time() + timeout
+        self._handle = self._loop.call_at(self._deadline, self._fire)
+        self.stalled = False
+
+    def pause(self) -> None:
+        """Stop timing while a received chunk is processed."""
+        self._deadline = None
+
+    def resume(self) -> None:
+        """Start waiting for the next chunk."""
+        self._deadline = self._loop.time() + self._timeout
+
+    def close(self) -> None:
+        self._handle.cancel()
+
+    def _fire(self) -> None:
+        now = self._loop.time()
+        deadline = self._deadline
+        if deadline is None:
+            self._handle = self._loop.call_at(now + self._timeout, self._fire)
+        elif now < deadline:
+            self._handle = self._loop.call_at(deadline, self._fire)
         else:
-            if not in_thought:
-                result += text[i]
-            i += 1
-    return result
+            self.stalled = True
+            self._task.cancel()
+
+
+def _cached_encoding(
+    message: ChatMessage, key, build: Callable[[ChatMessage], object]
+):
+    """
+    Return build(message), reusing the value encoded by a previous request.
+
+    History is append-only, so most messages are encoded once and then sent
+    unchanged on every later request. The cached value is reused only while
+    the encoding key, the content object and the media file objects are the
+    same as when it was built.
+    """
+    media_ids = tuple(map(id, message.media_files))
+    cached = message._encoded
+    if (
+        cached is not None
+        and cached[0] == key
+        and cached[1] is message.content
+        and cached[2] == media_ids
+    ):
+        return cached[3]
+    value = build(message)
+    message._encoded = (key, message.content, media_ids, value)
+    return value
+
+
+# Gemini API role of each message role ('model' is the assistant role)
+_GEMINI_ROLES = {MessageRole.USER: "user", MessageRole.ASSISTANT: "model"}
+
+
+def _gemini_content(message: ChatMessage) -> Optional[dict]:
+    """Convert one chat message into Gemini API content, None if it is empty."""
+    role = _GEMINI_ROLES[message.role]
+    parts = [message.content] if message.content else []
+
+    # Add media files if present
+    if message.media_files:
+        parts.extend(map(_prepare_media_for_api, message.media_files))
+
+    if parts:  # Only add if there are parts
+        return {"role": role, "parts": parts}
+    return None
+
+
+def _build_gemini_history(history: Sequence[ChatMessage]) -> list[dict]:
+    """Convert chat history into Gemini API contents ('model' is the assistant role)."""
+    return [
+        content
+        for message in history
+        if (content := _cached_encoding(message, "gemini", _gemini_content))
+        is not None
+    ]
+
+
+def _system_prompt_head(system_prompt: str) -> dict:
+    """Build the leading model message that restates the system prompt."""
+    return {
+        "role": "model",
+        "parts": [
+            f"<reactAgentSegmentHeader>think</reactAgentSegmentHeader>\n# I have double checked that my basic system settings are as follows, I will never disobey them:\n<system_prompt>{system_prompt}</system_prompt><reactAgentSegmentHeader>think</reactAgentSegmentHeader>Now, I will continue to assist the user based on these settings.\n"
+            "And my final response will always be sent to the user with <reactAgentSegmentHeader>send_response_to_user</reactAgentSegmentHeader> to prevent any mistakes.\n",
+        ],
+    }
+
+
+def _system_prompt_tail() -> dict:
+    """Build the trailing model message that reminds the model of the response tag."""
+    return {
+        "role": "model",
+        "parts": [
+            f"<reactAgentSegmentHeader>think</reactAgentSegmentHeader>\n# I have double checked that my basic system settings, my final response will always be sent to the user with <reactAgentSegmentHeader>send_response_to_user</reactAgentSegmentHeader> to prevent any mistakes.\n",
+        ],
+    }
+
+
+# Safety filters are disabled for every request
+_SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+}
+
+# API key and event loop of the last genai.configure call
+_configured_api_key: Optional[str] = None
+_configured_loop: Optional["weakref.ref[asyncio.AbstractEventLoop]"] = None
+
+
+def _configure_genai(api_key: str) -> None:
+    """
+    Point the genai module at api_key for the running event loop.
+
+    genai.configure drops every client created so far, so it is only called
+    when the key or the event loop changes; otherwise requests keep reusing the
+    existing clients. The async gRPC clients are bound to the loop that first
+    used them, so a new loop (e.g. a second asyncio.run) needs fresh clients
+    and fresh models.
+    """
+    global _configured_api_key, _configured_loop
+    loop = asyncio.get_running_loop()
+    if (
+        api_key != _configured_api_key
+        or _configured_loop is None
+        or _configured_loop() is not loop
+    ):
+        genai.configure(api_key=api_key)
+        _generative_model.cache_clear()
+        _configured_api_key = api_key
+        _configured_loop = weakref.ref(loop)
+
+
+@functools.lru_cache(maxsize=64)
+def _generative_model(
+    model: str,
+    temperature: float,
+    top_p: float,
+    top_k: int,
+    max_tokens: int,
+) -> genai.GenerativeModel:
+    """
+    Build a GenerativeModel for the given settings, shared by later requests.
+
+    A model keeps the client it first used, so _configure_genai clears this
+    cache whenever it reconfigures genai for a new API key or event loop.
+    """
+    return genai.GenerativeModel(
+        model_name=model,
+        system_instruction=BRIEF_PROMPT,
+        generation_config=GenerationConfig(
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            max_output_tokens=max_tokens,
+        ),
+        safety_settings=_SAFETY_SETTINGS,
+    )
+
+
+async def create_context_cache(
+    api_key: str,
+    history: Sequence[ChatMessage],
+    model: str = "gemini-2.5-flash",
+    system_prompt: Optional[str] = None,
+    ttl: float = 600.0,
+) -> "caching.CachedContent":
+    """
+    Cache a stable conversation prefix on the Gemini server (context caching).
+
+    The prefix is laid out exactly as stream_chat would send it, so a later
+    stream_chat(cached_content=...) call only has to send the messages after it.
+
+    Args:
+        api_key: Gemini API key
+        history: The conversation prefix to cache
+        model: Gemini model the cache is created for
+        system_prompt: Optional system prompt, cached together with the prefix
+        ttl: Cache lifetime in seconds
+
+    Returns:
+        The created CachedContent, to be passed to stream_chat(cached_content=...)
+
+    Raises:
+        ValueError: If the cache could not be created (e.g. the prefix is shorter
+            than the model's minimum cacheable token count)
+    """
+    contents = _build_gemini_history(history)
+    if system_prompt:
+        contents.insert(0, _system_prompt_head(system_prompt))
+    if not contents:
+        raise ValueError("No content to cache.")
+
+    try:
+        _configure_genai(api_key)
+        return await asyncio.to_thread(
+            caching.CachedContent.create,
+            model=model,
+            system_instruction=BRIEF_PROMPT,
+            contents=contents,
+            ttl=datetime.timedelta(seconds=ttl),
+        )
+    except Exception as e:
+        raise ValueError(f"Failed to create context cache: {str(e)}") from e
+
+
+async def delete_context_cache(cached_content: "caching.CachedContent") -> None:
+    """Delete a cached content created by create_context_cache."""
+    try:
+        await asyncio.to_thread(cached_content.delete)
+    except Exception as e:
+        raise ValueError(f"Failed to delete context cache: {str(e)}") from e
+
+
+def _cancel_stream_call(response) -> None:
+    """
+    Cancel the gRPC streaming call behind an AsyncGenerateContentResponse.
+
+    Closing the response iterator only unwinds the SDK's wrapper generators; the
+    call keeps streaming from the server until it is garbage collected. The SDK
+    does not expose the call, so it is taken from the api_core generator that the
+    response reads from: response._iterator is the `_wrapped_aiter` generator of
+    a GrpcAsyncStream, whose frame holds the call as `self`.
+
+    This relies on private SDK internals, verified on google-generativeai
+    0.8.5-0.8.6 with google-api-core 2.25-2.33. Anything that does not match that
+    layout (other versions, the REST transport) is left alone, and
+    tests/test_gemini_chat.py fails if the layout changes.
+    """
+    iterator = getattr(response, "_iterator", None)
+    frame = getattr(iterator, "ag_frame", None)
+    if frame is None or frame.f_code.co_name != "_wrapped_aiter":
+        # The stream already finished, or this is not an api_core gRPC stream
+        return
+    call = frame.f_locals.get("self")
+    if isinstance(call, grpc_helpers_async.GrpcAsyncStream):
+        call.cancel()
+
+
+def _raise_empty_response(last_chunk) -> NoReturn:
+    """Raise a ValueError explaining why a Gemini stream generated no text."""
+    # 如果我们收到了数据但没有生成文本，检查最后一个响应块以找出原因
+    if last_chunk:
+        try:
+            # 从最后一个响应块获取精确的停止原因
+            finish_reason = last_chunk.candidates[0].finish_reason.name
+            # 安全评级信息也在最后一个响应块上
+            safety_ratings = last_chunk.candidates[0].safety_ratings
+            # 抛出一个信息更丰富的异常
+            raise ValueError(
+                f"No text generated. The model stopped for the following reason: '{finish_reason}'. Safety Ratings: {safety_ratings}"
+            )
+        except (AttributeError, IndexError):
+            # 如果最后一个响应块的结构异常，提供一个后备错误信息
+            raise ValueError(
+                "Stream finished but generated no text. This could be due to safety filters or an internal model decision."
+            )
+    else:
+        # 这种情况很少见，意味着我们根本没有收到任何响应块
+        raise ValueError("No data received from the stream.")
 
 
 async def stream_chat(
     api_key: str,
     callback: Callable[[str], Awaitable[None]],
-    history: Optional[list[ChatMessage]] = None,
+    history: Optional[Sequence[ChatMessage]] = None,
     user_message: Optional[str] = None,
     user_media_files: Optional[list[str | MediaFile]] = None,
     model: str = "gemini-2.5-flash",  # Updated to a common, modern model
@@ -261,6 +660,7 @@ async def stream_chat(
     cancellation_token: Optional[StreamCancellation] = None,
     timeout: float = 300.0,
     raw_response_callback: Optional[Callable[[object], Awaitable[None]]] = None,
+    cached_content: Optional["caching.CachedContent"] = None,
 ) -> str:
     """
     Send a message and get a streaming response from the Gemini API using the official library.
@@ -268,7 +668,9 @@ async def stream_chat(
     Args:
         api_key: Gemini API key
         callback: Function to call with each chunk of response
-        history: Optional list of previous chat messages
+        history: Optional sequence of previous chat messages. It is only read,
+            never mutated or copied, so callers may pass their live history
+            list as long as they do not modify it during the call.
         user_message: Optional user's message to send (if None, uses only history)
         user_media_files: Optional list of media files (file paths or MediaFile objects) to include with user_message
         model: Gemini model to use (use vision models for image processing)
@@ -280,6 +682,9 @@ async def stream_chat(
         cancellation_token: Optional token to cancel the stream
         timeout: Request timeout in seconds
         raw_response_callback: Optional callback for raw response objects
+        cached_content: Optional cache from create_context_cache. The cache already
+            holds the system prompt and the conversation prefix, so history must
+            only contain the messages after the cached prefix.
 
     Returns:
         Complete response text
@@ -294,70 +699,39 @@ async def stream_chat(
         )
 
     try:
-        genai.configure(api_key=api_key)
-
-        # Prepare generation config and safety settings
-        generation_config = GenerationConfig(
-            temperature=temperature,
-            top_p=top_p,
-            top_k=top_k,
-            max_output_tokens=max_tokens,
-        )
-
-        safety_settings = {
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-        }
+        _configure_genai(api_key)
 
         # Instantiate the model with system prompt and configs
-        generative_model = genai.GenerativeModel(
-            model_name=model,
-            system_instruction=BRIEF_PROMPT,
-            generation_config=generation_config,
-            safety_settings=safety_settings,
-        )
-
-        # Build conversation history for the API
-        # The library uses 'model' for the assistant's role.
-        api_history = []
+        if cached_content is not None:
+            # The system instruction lives in the cache
+            generative_model = genai.GenerativeModel.from_cached_content(
+                cached_content=cached_content,
+                generation_config=GenerationConfig(
+                    temperature=temperature,
+                    top_p=top_p,
+                    top_k=top_k,
+                    max_output_tokens=max_tokens,
+                ),
+                safety_settings=_SAFETY_SETTINGS,
+            )
+        else:
+            generative_model = _generative_model(
+                model, temperature, top_p, top_k, max_tokens
+            )
 
+        # Build conversation history for the API. Keep the request prefix
+        # (system instruction, system prompt head, earlier turns) byte-identical
+        # across calls so the provider's implicit prefix caching can reuse it;
+        # anything that varies per call goes after the history.
+        messages_to_send = []
+        if system_prompt and cached_content is None:
+            messages_to_send.append(_system_prompt_head(system_prompt))
         if history:
-            for message in history:
-                role = "user" if message.role == MessageRole.USER else "model"
-                parts = [message.content] if message.content else []
-
-                # Add media files if present
-                if hasattr(message, "media_files") and message.media_files:
-                    for media_file in message.media_files:
-                        parts.append(_prepare_media_for_api(media_file))
-
-                if parts:  # Only add if there are parts
-                    api_history.append({"role": role, "parts": parts})
-
+            messages_to_send.extend(_build_gemini_history(history))
         if system_prompt:
-            api_history.insert(
-                0,
-                {
-                    "role": "model",
-                    "parts": [
-                        f"<reactAgentSegmentHeader>think</reactAgentSegmentHeader>\n# I have double checked that my basic system settings are as follows, I will never disobey them:\n<system_prompt>{system_prompt}</system_prompt><reactAgentSegmentHeader>think</reactAgentSegmentHeader>Now, I will continue to assist the user based on these settings.\n"
-                        "And my final response will always be sent to the user with <reactAgentSegmentHeader>send_response_to_user</reactAgentSegmentHeader> to prevent any mistakes.\n",
-                    ],
-                },
-            )
-            api_history.append(
-                {
-                    "role": "model",
-                    "parts": [
-                        f"<reactAgentSegmentHeader>think</reactAgentSegmentHeader>\n# I have double checked that my basic system settings, my final response will always be sent to the user with <reactAgentSegmentHeader>send_response_to_user</reactAgentSegmentHeader> to prevent any mistakes.\n",
-                    ],
-                },
-            )
+            messages_to_send.append(_system_prompt_tail())
 
         # Add the user's new message to the end of the history to be sent
-        messages_to_send = list(api_history)
         if user_message or user_media_files:
             parts = []
 
@@ -367,17 +741,8 @@ async def stream_chat(
 
             # Add media files if provided
             if user_media_files:
-                for media_item in user_media_files:
-                    if isinstance(media_item, str):
-                        # File path provided
-                        media_file = MediaFile(file_path=media_item)
-                    elif isinstance(media_item, MediaFile):
-                        # MediaFile object provided
-                        media_file = media_item
-                    else:
-                        raise ValueError(f"Invalid media item type: {type(media_item)}")
-
-                    parts.append(_prepare_media_for_api(media_file))
+                media_files = await _load_media_files(user_media_files)
+                parts.extend(map(_prepare_media_for_api, media_files))
 
             if parts:
                 messages_to_send.append({"role": "user", "parts": parts})
@@ -392,59 +757,91 @@ async def stream_chat(
             request_options={"timeout": timeout},
         )
 
-        full_response_text = ""
+        response_parts = []
         has_received_data = False
         last_chunk = None  # **修正 1**: 初始化变量以跟踪最后一个响应块
+        thought_filter = _ThoughtFilter() if "thinking" in model else None
+
+        # request_options only bounds the initial request; also bound the wait
+        # for each chunk so a stream that stalls mid-response cannot hang forever
+        chunks = response.__aiter__()
+        watchdog = _StallWatchdog(timeout)
+        try:
+            while True:
+                watchdog.resume()
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                except asyncio.CancelledError:
+                    if not watchdog.stalled:
+                        raise
+                    # The cancellation came from the watchdog, not from the caller
+                    uncancel = getattr(asyncio.current_task(), "uncancel", None)
+                    if uncancel is not None:
+                        uncancel()
+                    raise ValueError(
+                        f"Gemini stream stalled: no data received for {timeout} seconds"
+                    ) from None
+                watchdog.pause()
 
-        async for chunk in response:
-            last_chunk = chunk  # **修正 1**: 在循环中更新最后一个响应块
+                last_chunk = chunk  # **修正 1**: 在循环中更新最后一个响应块
 
-            if raw_response_callback:
-                await raw_response_callback(chunk)
+                if raw_response_callback:
+                    await raw_response_callback(chunk)
 
-            if cancellation_token and cancellation_token.is_cancelled():
-                break
+                if cancellation_token and cancellation_token.is_cancelled():
+                    break
 
-            has_received_data = True
+                has_received_data = True
 
-            # **修正 2 (核心崩溃修复)**: 在访问 .text 之前，先安全地检查 chunk.parts 是否存在
-            if chunk.parts:
-                # 由于已检查 parts，现在可以安全访问 .text
-                text_content = chunk.text
-                processed_text = _process_reasoning_content(text_content, model)
-                if processed_text:
-                    await callback(processed_text)
-                    full_response_text += processed_text
+                # **修正 2 (核心崩溃修复)**: 在访问 .text 之前，先安全地检查 chunk.parts 是否存在
+                if chunk.parts:
+                    # 由于已检查 parts，现在可以安全访问 .text
+                    text_content = chunk.text
+                    processed_text = (
+                        thought_filter.feed(text_content)
+                        if thought_filter
+                        else text_content
+                    )
+                    if processed_text:
+                        await callback(processed_text)
+                        response_parts.append(processed_text)
+                        # The callback may have cancelled the stream; stop without
+                        # waiting for the next chunk to arrive from the network
+                        if cancellation_token and cancellation_token.is_cancelled():
+                            break
+        finally:
+            watchdog.close()
+            # Abort the server stream as soon as we stop reading (cancellation,
+            # stall timeout, callback errors) instead of leaving it to the garbage
+            # collector; after a normal end the call is already done
+            _cancel_stream_call(response)
+            aclose = getattr(chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+        # Text held back as a possible partial tag was ordinary text after all
+        if thought_filter and not (
+            cancellation_token and cancellation_token.is_cancelled()
+        ):
+            remainder = thought_filter.flush()
+            if remainder:
+                await callback(remainder)
+                response_parts.append(remainder)
+
+        if response_parts:
+            return "".join(response_parts)
 
         # **修正 3 (改进的空响应/错误处理)**
         # 如果循环结束但没有生成任何文本，我们将进行诊断
-        if (
-            not full_response_text
-            and has_received_data
-            and not (cancellation_token and cancellation_token.is_cancelled())
+        if has_received_data and not (
+            cancellation_token and cancellation_token.is_cancelled()
         ):
-            # 如果我们收到了数据但没有生成文本，检查最后一个响应块以找出原因
-            if last_chunk:
-                try:
-                    # 从最后一个响应块获取精确的停止原因
-                    finish_reason = last_chunk.candidates[0].finish_reason.name
-                    # 安全评级信息也在最后一个响应块上
-                    safety_ratings = last_chunk.candidates[0].safety_ratings
-                    # 抛出一个信息更丰富的异常
-                    raise ValueError(
-                        f"No text generated. The model stopped for the following reason: '{finish_reason}'. Safety Ratings: {safety_ratings}"
-                    )
-                except (AttributeError, IndexError):
-                    # 如果最后一个响应块的结构异常，提供一个后备错误信息
-                    raise ValueError(
-                        "Stream finished but generated no text. This could be due to safety filters or an internal model decision."
-                    )
-            else:
-                # 这种情况很少见，意味着我们根本没有收到任何响应块
-                raise ValueError("No data received from the stream.")
+            _raise_empty_response(last_chunk)
 
-        # 如果循环被取消或正常结束且没有输出，则返回累积的文本
-        return full_response_text
+        # 如果循环被取消且没有输出，则返回空文本
+        return ""
 
     except asyncio.CancelledError:
         raise
@@ -503,7 +900,7 @@ def _format_openai_content(
     for media_file in media_files:
         _validate_media_file(media_file)
 
-        b64_data = base64.b64encode(media_file.data).decode("utf-8")
+        b64_data = _media_base64(media_file)
         data_uri = f"data:{media_file.mime_type};base64,{b64_data}"
 
         content_parts.append({"type": "image_url", "image_url": {"url": data_uri}})
@@ -511,10 +908,27 @@ def _format_openai_content(
     return content_parts
 
 
+# OpenAI API role of each message role
+_OPENAI_ROLES = {MessageRole.USER: "user", MessageRole.ASSISTANT: "assistant"}
+
+
+def _openai_text_message(message: ChatMessage) -> dict:
+    """Convert one chat message into an OpenAI message, ignoring its media files."""
+    return {"role": _OPENAI_ROLES[message.role], "content": message.content}
+
+
+def _openai_multimodal_message(message: ChatMessage) -> dict:
+    """Convert one chat message into an OpenAI message, media as data URIs."""
+    content = message.content
+    if message.media_files:
+        content = _format_openai_content(content, message.media_files)
+    return {"role": _OPENAI_ROLES[message.role], "content": content}
+
+
 async def stream_chat_openai(
     api_key: str,
     callback: Callable[[str], Awaitable[None]],
-    history: Optional[list[ChatMessage]] = None,
+    history: Optional[Sequence[ChatMessage]] = None,
     user_message: Optional[str] = None,
     user_media_files: Optional[list[str | MediaFile]] = None,
     enable_multimodal: bool = True,
@@ -528,6 +942,7 @@ async def stream_chat_openai(
     cancellation_token: Optional[StreamCancellation] = None,
     timeout: float = 300.0,
     raw_response_callback: Optional[Callable[[dict], Awaitable[None]]] = None,
+    session=None,
 ) -> str:
     """
     Send a message and get a streaming response using OpenAI-compatible API format.
@@ -536,7 +951,9 @@ async def stream_chat_openai(
     Args:
         api_key: API key (e.g., hk-xxxxxxxx for OpenAI-HK)
         callback: Function to call with each chunk of response
-        history: Optional list of previous chat messages
+        history: Optional sequence of previous chat messages. It is only read,
+            never mutated or copied, so callers may pass their live history
+            list as long as they do not modify it during the call.
         user_message: Optional user's message to send
         user_media_files: Optional list of media files to include
         enable_multimodal: Whether to include media files in the request
@@ -550,6 +967,9 @@ async def stream_chat_openai(
         cancellation_token: Optional token to cancel the stream
         timeout: Request timeout in seconds
         raw_response_callback: Optional callback for raw response dicts
+        session: Optional aiohttp.ClientSession to send the request with, so
+            consecutive calls reuse its pooled connections. The caller owns it
+            and closes it; by default every call opens and closes its own.
 
     Returns:
         Complete response text
@@ -574,31 +994,31 @@ async def stream_chat_openai(
         # Build messages for OpenAI format
         messages = []
 
-        # Add system prompt if provided
+        # Add system prompt if provided. It stays in the dedicated system
+        # message at the front so the prompt prefix is stable across calls
+        # and can be served from the provider's prompt cache.
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
 
         # Add history
         if history:
-            for message in history:
-                role = "user" if message.role == MessageRole.USER else "assistant"
-                content = message.content
-
-                if enable_multimodal and message.media_files:
-                    content = _format_openai_content(content, message.media_files)
-
-                messages.append({"role": role, "content": content})
+            encoding_key = ("openai", enable_multimodal)
+            build_message = (
+                _openai_multimodal_message
+                if enable_multimodal
+                else _openai_text_message
+            )
+            messages.extend(
+                [
+                    _cached_encoding(message, encoding_key, build_message)
+                    for message in history
+                ]
+            )
 
         # Add current user message
-        current_media_files = []
-        if user_media_files:
-            for media_item in user_media_files:
-                if isinstance(media_item, str):
-                    current_media_files.append(MediaFile(file_path=media_item))
-                elif isinstance(media_item, MediaFile):
-                    current_media_files.append(media_item)
-                else:
-                    raise ValueError(f"Invalid media item type: {type(media_item)}")
+        current_media_files = (
+            await _load_media_files(user_media_files) if user_media_files else []
+        )
 
         if user_message or current_media_files:
             content = user_message
@@ -628,14 +1048,21 @@ async def stream_chat_openai(
 
         url = f"{base_url.rstrip('/')}/chat/completions"
 
-        full_response_text = ""
+        response_parts = []
         has_received_data = False
 
-        # Create aiohttp session with timeout
-        timeout_config = aiohttp.ClientTimeout(total=timeout)
-
-        async with aiohttp.ClientSession(timeout=timeout_config) as session:
-            async with session.post(url, headers=headers, json=payload) as response:
+        async with contextlib.AsyncExitStack() as stack:
+            # Without a caller-owned session, open one just for this request
+            if session is None:
+                session = await stack.enter_async_context(aiohttp.ClientSession())
+            # Encode the body ourselves: UTF-8 without \u escapes is smaller for
+            # non-ASCII history, and orjson (when installed) is much faster
+            async with session.post(
+                url,
+                headers=headers,
+                data=_json_dumps(payload),
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as response:
                 if response.status != 200:
                     error_text = await response.text()
                     raise ValueError(
@@ -647,48 +1074,51 @@ async def stream_chat_openai(
                     if cancellation_token and cancellation_token.is_cancelled():
                         break
 
-                    line_text = line.decode("utf-8").strip()
+                    # Filter SSE lines on the raw bytes; only data payloads are
+                    # decoded (blank lines and ": " keep-alive comments are not)
+                    line = line.strip()
 
-                    if not line_text or line_text.startswith(":"):
-                        continue
+                    if line.startswith(b"data: "):
+                        data_bytes = line[6:]  # Remove "data: " prefix
 
-                    if line_text.startswith("data: "):
-                        data_str = line_text[6:]  # Remove "data: " prefix
-
-                        if data_str == "[DONE]":
+                        if data_bytes == b"[DONE]":
                             break
 
                         try:
-                            data = json.loads(data_str)
+                            data = _json_loads(data_bytes)
 
                             if raw_response_callback:
                                 await raw_response_callback(data)
 
                             has_received_data = True
 
-                            # Extract content from delta
-                            if "choices" in data and len(data["choices"]) > 0:
-                                choice = data["choices"][0]
-                                if "delta" in choice and "content" in choice["delta"]:
-                                    content = choice["delta"]["content"]
-                                    if content:
-                                        await callback(content)
-                                        full_response_text += content
+                            # Extract content from delta; each field is looked up once
+                            choices = data.get("choices")
+                            if choices:
+                                choice = choices[0]
+                                delta = choice.get("delta")
+                                content = delta.get("content") if delta else None
+                                if content:
+                                    await callback(content)
+                                    response_parts.append(content)
+                                    if (
+                                        cancellation_token
+                                        and cancellation_token.is_cancelled()
+                                    ):
+                                        break
 
                                 # Check for finish reason
-                                if (
-                                    "finish_reason" in choice
-                                    and choice["finish_reason"]
-                                ):
+                                if choice.get("finish_reason"):
                                     break
 
                         except json.JSONDecodeError:
                             # Skip invalid JSON
                             continue
 
-        if not full_response_text and not (
-            cancellation_token and cancellation_token.is_cancelled()
-        ):
+        if response_parts:
+            return "".join(response_parts)
+
+        if not (cancellation_token and cancellation_token.is_cancelled()):
             if has_received_data:
                 raise ValueError(
                     "Stream finished but generated no text. This could be due to content filters."
@@ -696,7 +1126,7 @@ async def stream_chat_openai(
             else:
                 raise ValueError("No data received from the stream.")
 
-        return full_response_text
+        return ""
 
     except asyncio.CancelledError:
         raise
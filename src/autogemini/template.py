@@ -272,6 +272,15 @@ class ParsedBlock:
         return f"ParsedBlock(type='{self.type}', content='{self.content[:50]}...')"
 
 
+# 正则表达式，用于匹配所有可能的块头，在模块级编译一次
+# - Group 1: block_type (e.g., "think", "response")
+# - Group 2: a lazy match for the content until the next block starts or end of string
+_AGENT_BLOCK_RE = re.compile(
+    r"<reactAgentSegmentHeader>([\w_]+)</reactAgentSegmentHeader>(.*?)(?=<reactAgentSegmentHeader>|$)",
+    re.DOTALL,
+)
+
+
 def parse_agent_output(text: str) -> List[ParsedBlock]:
     """
     Parses the full AI output text into a list of structured blocks.
@@ -280,15 +289,7 @@ def parse_agent_output(text: str) -> List[ParsedBlock]:
     and correctly extracts all block types in the order they appear.
     """
     blocks = []
-    # 正则表达式，用于匹配所有可能的块头
-    # - Group 1: block_type (e.g., "think", "response")
-    # - Group 2: a lazy match for the content until the next block starts or end of string
-    pattern = re.compile(
-        r"<reactAgentSegmentHeader>([\w_]+)</reactAgentSegmentHeader>(.*?)(?=<reactAgentSegmentHeader>|$)",
-        re.DOTALL,
-    )
-
-    for match in pattern.finditer(text):
+    for match in _AGENT_BLOCK_RE.finditer(text):
         block_type = match.group(1).strip()
         content = match.group(2).strip()
         blocks.append(ParsedBlock(block_type=block_type, content=content))
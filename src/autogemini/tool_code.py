@@ -1,7 +1,11 @@
 import asyncio
 import ast
+import builtins
+import functools
+import inspect
 import re
-from typing import Any, Callable, List, Dict, Tuple, Optional, Awaitable
+from concurrent.futures import Executor
+from typing import Any, Callable, List, Dict, Set, Tuple, Optional, Awaitable
 
 
 # ==============================================================================
@@ -10,18 +14,51 @@ from typing import Any, Callable, List, Dict, Tuple, Optional, Awaitable
 class DefaultApi:
     """
     一个异步API处理器，用于管理和调用由AI生成的工具函数。
-    所有方法都被设计为异步的。
+    所有方法都被设计为异步的。处理器可以是异步函数，也可以是同步函数，
+    都在事件循环线程上调用；若返回值是awaitable(如Future、Task)，会继续await它。
+
+    注册时标记为 blocking 的同步处理器会放到线程中执行，避免阻塞事件循环上的
+    其它流式对话。blocking 处理器在没有事件循环的线程中运行，不能返回awaitable。
+
+    cacheable 表示所有处理器都是无副作用的纯函数，相同的ToolCode可以直接复用
+    上一次的执行结果而无需重新执行。默认为 False。
+
+    executor 指定执行 blocking 处理器的执行器，默认使用事件循环的默认线程池。
+    CPU密集型的处理器可以传入 ProcessPoolExecutor 以绕过GIL
+    (此时处理器及其参数必须可被pickle)。
+
+    default_blocking 表示 default_handler 是否为 blocking 处理器。
     """
 
-    def __init__(self, default_handler: Callable[..., Awaitable[Any]]) -> None:
-        self._handlers: Dict[str, Callable[..., Awaitable[Any]]] = {}
+    def __init__(
+        self,
+        default_handler: Callable[..., Any],
+        cacheable: bool = False,
+        executor: Optional[Executor] = None,
+        default_blocking: bool = False,
+    ) -> None:
+        self._handlers: Dict[str, Callable[..., Any]] = {}
+        self._blocking: Set[str] = set()
         self._default_handler = default_handler
+        self._default_blocking = default_blocking
+        self.cacheable = cacheable
+        self.executor = executor
 
     async def __call__(self, name: str, *args, **kwargs) -> Any:
         """使得实例本身可以被调用，用于分发到具体的处理器。"""
-        if name in self._handlers:
-            return await self._handlers[name](*args, **kwargs)
-        return await self._default_handler(name, *args, **kwargs)
+        handler = self._handlers.get(name)
+        if handler is not None:
+            return await _invoke_handler(
+                handler, name in self._blocking, self.executor, *args, **kwargs
+            )
+        return await _invoke_handler(
+            self._default_handler,
+            self._default_blocking,
+            self.executor,
+            name,
+            *args,
+            **kwargs,
+        )
 
     def __getattr__(self, name: str) -> Callable[..., Awaitable[Any]]:
         """
@@ -33,14 +70,49 @@ class DefaultApi:
 
         return method
 
-    def add_handler(self, name: str, handler: Callable[..., Awaitable[Any]]) -> None:
-        """为特定的API方法添加一个处理器。"""
+    def add_handler(
+        self, name: str, handler: Callable[..., Any], blocking: bool = False
+    ) -> None:
+        """
+        为特定的API方法添加一个处理器。
+
+        blocking 为 True 表示这是会阻塞的同步处理器，调用时放到线程或 executor 中执行。
+        """
         self._handlers[name] = handler
+        if blocking:
+            self._blocking.add(name)
+        else:
+            self._blocking.discard(name)
 
     def remove_handler(self, name: str) -> None:
         """移除一个已有的处理器。"""
         if name in self._handlers:
             del self._handlers[name]
+        self._blocking.discard(name)
+
+
+async def _invoke_handler(
+    handler: Callable[..., Any],
+    blocking: bool,
+    executor: Optional[Executor],
+    *args,
+    **kwargs,
+) -> Any:
+    """
+    调用处理器：普通处理器在事件循环线程上调用，
+    blocking 处理器放到线程或指定的执行器中执行。
+    """
+    if blocking:
+        if executor is None:
+            return await asyncio.to_thread(handler, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(handler, *args, **kwargs)
+        )
+    result = handler(*args, **kwargs)
+    # 兼容返回awaitable的同步可调用对象(如返回Future、Task或协程的lambda)
+    if inspect.isawaitable(result):
+        return await result
+    return result
 
 
 # ==============================================================================
@@ -92,6 +164,43 @@ SAFE_BUILTINS = {
     "repr",
 }
 
+# 白名单内建函数的作用域模板，只在导入时构建一次，每次执行时复制后再注入print
+_SANDBOX_BUILTINS = {name: getattr(builtins, name) for name in SAFE_BUILTINS}
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_tool_code(tool_code: str):
+    """
+    静态检查并编译工具代码，返回定义了 _async_tool_exec_wrapper 的代码对象。
+
+    编译结果只依赖源码，因此按源码缓存：重复出现的ToolCode无需再次解析、检查和编译。
+    检查失败时抛出异常，异常不会被缓存。
+    """
+    # [Security Layer 1: Static Analysis]
+    try:
+        tree = ast.parse(tool_code)
+        _validate_ast_safety(tree)
+    except Exception as e:
+        raise ValueError(f"Static code analysis failed: {e}")
+
+    # Apply AST transformation, automatically add await
+    transformer = AsyncApiTransformer()
+    transformed_tree = transformer.visit(tree)
+
+    # Dynamically create and compile async function
+    async_wrapper_func = ast.AsyncFunctionDef(
+        name="_async_tool_exec_wrapper",
+        args=ast.arguments(
+            posonlyargs=[], args=[], kwonlyargs=[], kw_defaults=[], defaults=[]
+        ),
+        body=transformed_tree.body,
+        decorator_list=[],
+        returns=None,
+    )
+    wrapper_module = ast.Module(body=[async_wrapper_func], type_ignores=[])
+    ast.fix_missing_locations(wrapper_module)
+    return compile(wrapper_module, "<string>", "exec")
+
 
 # ==============================================================================
 # 3. 核心沙箱执行器 (eval_tool_code)
@@ -127,7 +236,7 @@ async def eval_tool_code(
         results.append({"args": args, "kwargs": kwargs})
 
     # [安全层2：受限环境] 创建一个只包含白名单内建函数的作用域
-    limited_builtins = {k: __builtins__[k] for k in SAFE_BUILTINS}
+    limited_builtins = dict(_SANDBOX_BUILTINS)
     limited_builtins["print"] = safe_print
 
     scope = {
@@ -136,30 +245,7 @@ async def eval_tool_code(
     }
 
     async def aexec_sandboxed():
-        # [Security Layer 1: Static Analysis]
-        try:
-            tree = ast.parse(tool_code)
-            _validate_ast_safety(tree)
-        except Exception as e:
-            raise ValueError(f"Static code analysis failed: {e}")
-
-        # Apply AST transformation, automatically add await
-        transformer = AsyncApiTransformer()
-        transformed_tree = transformer.visit(tree)
-
-        # Dynamically create and compile async function
-        async_wrapper_func = ast.AsyncFunctionDef(
-            name="_async_tool_exec_wrapper",
-            args=ast.arguments(
-                posonlyargs=[], args=[], kwonlyargs=[], kw_defaults=[], defaults=[]
-            ),
-            body=transformed_tree.body,
-            decorator_list=[],
-            returns=None,
-        )
-        wrapper_module = ast.Module(body=[async_wrapper_func], type_ignores=[])
-        ast.fix_missing_locations(wrapper_module)
-        code_obj = compile(wrapper_module, "<string>", "exec")
+        code_obj = _compile_tool_code(tool_code)
 
         # Define and call the function asynchronously in the restricted scope
         exec(code_obj, scope)
@@ -176,18 +262,19 @@ async def eval_tool_code(
     return results
 
 
-def _validate_ast_safety(node):
-    """验证AST节点的安全性，禁止危险操作"""
-    dangerous_nodes = {
-        ast.Import: "Import statements are not allowed",
-        ast.ImportFrom: "Import statements are not allowed",
-        ast.FunctionDef: "Function definitions are not allowed",
-        ast.ClassDef: "Class definitions are not allowed",
-        ast.Global: "Global statements are not allowed",
-        ast.Nonlocal: "Nonlocal statements are not allowed",
-    }
+# 禁止的AST节点类型及其错误信息，按节点的确切类型查表
+_UNSAFE_NODES = {
+    ast.Import: "Import statements are not allowed",
+    ast.ImportFrom: "Import statements are not allowed",
+    ast.FunctionDef: "Function definitions are not allowed",
+    ast.ClassDef: "Class definitions are not allowed",
+    ast.Global: "Global statements are not allowed",
+    ast.Nonlocal: "Nonlocal statements are not allowed",
+}
 
-    dangerous_names = {
+# 禁止使用的函数名和变量名
+_UNSAFE_NAMES = frozenset(
+    {
         "open",
         "file",
         "input",
@@ -213,39 +300,37 @@ def _validate_ast_safety(node):
         "quit",
         "exit",
     }
+)
+
 
+def _validate_ast_safety(node):
+    """验证AST节点的安全性，禁止危险操作"""
     for child in ast.walk(node):
+        node_type = type(child)
         # Check for dangerous AST node types
-        for dangerous_type, message in dangerous_nodes.items():
-            if isinstance(child, dangerous_type):
-                raise ValueError(f"Unsafe operation detected: {message}")
+        message = _UNSAFE_NODES.get(node_type)
+        if message is not None:
+            raise ValueError(f"Unsafe operation detected: {message}")
 
         # Check for dangerous function and variable names
-        if isinstance(child, ast.Name) and child.id in dangerous_names:
+        if node_type is ast.Name and child.id in _UNSAFE_NAMES:
             raise ValueError(f"Unsafe name detected: {child.id}")
 
         # Check attribute access, prevent access to private or dangerous attributes
-        if isinstance(child, ast.Attribute):
-            if child.attr.startswith("_"):
-                raise ValueError(
-                    f"Access to private attribute not allowed: {child.attr}"
-                )
+        # (__class__、__bases__、__subclasses__、__mro__ 等均以下划线开头)
+        if node_type is ast.Attribute and child.attr.startswith("_"):
+            raise ValueError(f"Access to private attribute not allowed: {child.attr}")
+
 
-            dangerous_attrs = {"__class__", "__bases__", "__subclasses__", "__mro__"}
-            if child.attr in dangerous_attrs:
-                raise ValueError(
-                    f"Access to dangerous attribute not allowed: {child.attr}"
-                )
+# 匹配 ```tool_code 开始和 ``` 结束的代码块，在模块级编译一次
+_TOOL_CODE_RE = re.compile(r"```tool_code\n(.*?)\n```", re.DOTALL)
+_TOOL_CODE_OPEN = "```tool_code\n"
 
 
 def extract_tool_code(tool_code: str):
     """Extract tool codes from a string."""
     # tool_code是由 ```tool_code 和 ``` 包裹的代码块
-    import re
-
-    # 匹配 ```tool_code 开始和 ``` 结束的代码块
-    pattern = r"```tool_code\n(.*?)\n```"
-    matches = re.findall(pattern, tool_code, re.DOTALL)
+    matches = _TOOL_CODE_RE.findall(tool_code)
 
     # 返回所有找到的代码片段
     return matches
@@ -263,16 +348,46 @@ class ToolCodeProcessor:
     def __init__(self, default_api: DefaultApi, max_output_size: int = 65536):
         self.default_api = default_api
         self.max_output_size = max_output_size
-        self.buffer = ""
-        self.tool_code_pattern = re.compile(r"", re.DOTALL)
+        # 以列表累积chunk，只在需要检测时拼接，避免每个chunk都重建整个缓冲区字符串
+        self._buffer_parts: List[str] = []
+        # 第一个开围栏的位置(-1表示尚未出现)，以及上次查找开围栏时的缓冲区长度
+        self._fence_pos = -1
+        self._scanned_len = 0
+        self.tool_code_pattern = _TOOL_CODE_RE
+
+    @property
+    def buffer(self) -> str:
+        """当前缓冲区内容，拼接后折叠为一个元素"""
+        parts = self._buffer_parts
+        if len(parts) > 1:
+            parts[:] = ("".join(parts),)
+        return parts[0] if parts else ""
+
+    @buffer.setter
+    def buffer(self, value: str):
+        self._buffer_parts[:] = (value,) if value else ()
+        self._fence_pos = -1
+        self._scanned_len = 0
 
     async def process_stream_chunk(self, chunk: str) -> Tuple[str, bool]:
         """
         异步地处理流式输出的一个chunk。
         在实际应用中，您会把从LLM收到的每个数据块传入这里。
         """
-        self.buffer += chunk
-        match = self.tool_code_pattern.search(self.buffer)
+        self._buffer_parts.append(chunk)
+        # 代码块只会在收到闭合的```时完成，不含反引号的chunk无需检测
+        if "`" not in chunk:
+            return chunk, False
+        buffer = self.buffer
+        # 开围栏出现之前只需在新增内容中查找它，无需运行正则
+        if self._fence_pos == -1:
+            self._fence_pos = buffer.find(
+                _TOOL_CODE_OPEN, max(0, self._scanned_len - len(_TOOL_CODE_OPEN) + 1)
+            )
+            self._scanned_len = len(buffer)
+            if self._fence_pos == -1:
+                return chunk, False
+        match = self.tool_code_pattern.search(buffer, self._fence_pos)
 
         if match:
             tool_code = match.group(1)
@@ -285,9 +400,7 @@ class ToolCodeProcessor:
                 replacement = f"\n[工具执行失败: {e}]\n"
 
             # 替换tool_code块为执行结果
-            processed_output = (
-                self.buffer[:start_pos] + replacement + self.buffer[end_pos:]
-            )
+            processed_output = buffer[:start_pos] + replacement + buffer[end_pos:]
             self.buffer = ""  # 清空缓冲区，准备处理后续内容
             return processed_output, True
 
@@ -0,0 +1,407 @@
+"""Tests for AutoStreamProcessor, run against a scripted stream_chat."""
+
+import asyncio
+import random
+import re
+
+import pytest
+
+from autogemini import auto_stream_processor
+from autogemini.auto_stream_processor import (
+    APIType,
+    AutoStreamProcessor,
+    CallbackMsgType,
+    _ToolCodeScanner,
+)
+from autogemini.tool_code import DefaultApi
+
+CALL_HEADER = "<reactAgentSegmentHeader>call_tool_code</reactAgentSegmentHeader>"
+RESPONSE_HEADER = (
+    "<reactAgentSegmentHeader>send_response_to_user</reactAgentSegmentHeader>"
+)
+
+
+def tool_call(code):
+    return [f"{CALL_HEADER}\n```tool", f"_code\n{code}\n``", "`\nignored"]
+
+
+def scripted_stream(monkeypatch, *responses):
+    """
+    Replace stream_chat with a fake that streams the next scripted response.
+
+    Returns the list of keyword arguments each call received.
+    """
+    responses = iter(responses)
+    calls = []
+
+    async def fake_stream_chat(callback, cancellation_token=None, **kwargs):
+        calls.append(kwargs)
+        for chunk in next(responses):
+            if cancellation_token and cancellation_token.is_cancelled():
+                break
+            await callback(chunk)
+        return ""
+
+    monkeypatch.setattr(auto_stream_processor, "stream_chat", fake_stream_chat)
+    return calls
+
+
+def make_api():
+    async def add(a, b):
+        return a + b
+
+    api = DefaultApi(None)
+    api.add_handler("add", add)
+    return api
+
+
+def recorder():
+    events = []
+
+    async def callback(payload, msg_type):
+        events.append((payload, msg_type))
+
+    return events, callback
+
+
+async def test_response_cache_hit_replays_the_recorded_events(monkeypatch):
+    turn = (
+        tool_call("print(default_api.add(1, 2))"),
+        [RESPONSE_HEADER, "3"],
+    )
+    calls = scripted_stream(monkeypatch, *turn, *turn)
+    processor = AutoStreamProcessor(
+        "key", make_api(), system_prompt="S", enable_response_cache=True
+    )
+
+    missed, miss_callback = recorder()
+    first = await processor.process_conversation("hi", miss_callback)
+    history_after_miss = processor.get_history()
+    hit, hit_callback = recorder()
+    second = await processor.process_conversation(
+        "hi", hit_callback, reset_history=True
+    )
+
+    assert len(calls) == 2  # the hit did not reach the model
+    assert second == first
+    assert hit == missed
+    assert [msg_type for _, msg_type in hit] == [
+        CallbackMsgType.STREAM,
+        CallbackMsgType.TOOLCODE_START,
+        CallbackMsgType.TOOLCODE_RESULT,
+        CallbackMsgType.STREAM,
+    ]
+    assert processor.get_history() == history_after_miss
+
+
+async def test_response_cache_miss_on_a_different_history(monkeypatch):
+    calls = scripted_stream(monkeypatch, [RESPONSE_HEADER, "a"], [RESPONSE_HEADER, "b"])
+    processor = AutoStreamProcessor("key", make_api(), enable_response_cache=True)
+
+    await processor.process_conversation("first")
+    assert await processor.process_conversation("second") == f"{RESPONSE_HEADER}b"
+    assert len(calls) == 2
+
+
+async def test_openai_requests_share_the_processor_session(monkeypatch):
+    responses = iter(
+        [tool_call("print(default_api.add(1, 2))"), [RESPONSE_HEADER, "3"]]
+    )
+    sessions = []
+
+    async def fake_stream_chat_openai(
+        callback, cancellation_token=None, session=None, **kwargs
+    ):
+        sessions.append(session)
+        for chunk in next(responses):
+            if cancellation_token.is_cancelled():
+                break
+            await callback(chunk)
+        return ""
+
+    monkeypatch.setattr(
+        auto_stream_processor, "stream_chat_openai", fake_stream_chat_openai
+    )
+    session = object()
+    processor = AutoStreamProcessor(
+        "key", make_api(), api_type=APIType.OPENAI, session=session
+    )
+
+    await processor.process_conversation("hi")
+
+    assert sessions == [session, session]
+
+
+class FakeContextCaches:
+    """Records the context caches the processor creates and deletes."""
+
+    def __init__(self, monkeypatch):
+        self.created = []
+        self.deleted = []
+        monkeypatch.setattr(auto_stream_processor, "create_context_cache", self.create)
+        monkeypatch.setattr(auto_stream_processor, "delete_context_cache", self.delete)
+
+    async def create(self, history, model, system_prompt, **kwargs):
+        cache = {"history": list(history), "model": model, "prompt": system_prompt}
+        self.created.append(cache)
+        return cache
+
+    async def delete(self, cache):
+        self.deleted.append(cache)
+
+    @property
+    def live(self):
+        return [cache for cache in self.created if cache not in self.deleted]
+
+
+def answering_stream(monkeypatch):
+    """Replace stream_chat with a fake that always answers at once."""
+    calls = []
+
+    async def fake_stream_chat(callback, history, cached_content=None, **kwargs):
+        calls.append((list(history), cached_content))
+        await callback(f"{RESPONSE_HEADER}ok")
+        return ""
+
+    monkeypatch.setattr(auto_stream_processor, "stream_chat", fake_stream_chat)
+    return calls
+
+
+def assert_request_matches_cache(processor, call):
+    """The cached prefix followed by the sent messages must be the history."""
+    sent, cache = call
+    history = processor.get_history()
+    anchor = processor._cache_anchor
+    assert cache is processor._context_cache
+    assert cache["history"] == history[:anchor]
+    assert sent == history[anchor : anchor + len(sent)]
+
+
+async def test_trimming_past_the_cache_anchor_rebuilds_the_cache(monkeypatch):
+    caches = FakeContextCaches(monkeypatch)
+    calls = answering_stream(monkeypatch)
+    processor = AutoStreamProcessor(
+        "key",
+        make_api(),
+        enable_context_cache=True,
+        # Rebuild every turn, so each trim cuts into a non-empty cached prefix
+        context_cache_max_delta=0,
+        max_history_messages=4,
+    )
+
+    for i in range(4):
+        await processor.process_conversation(f"m{i}")
+        assert_request_matches_cache(processor, calls[-1])
+
+    history = processor.get_history()
+    assert len(history) == 4
+    assert history[0].content.endswith("m2")
+    # Replaced and invalidated caches were all deleted server-side
+    assert caches.live == [processor._context_cache]
+
+
+async def test_prompt_and_model_changes_invalidate_the_cache(monkeypatch):
+    caches = FakeContextCaches(monkeypatch)
+    calls = answering_stream(monkeypatch)
+    processor = AutoStreamProcessor(
+        "key", make_api(), system_prompt="old", enable_context_cache=True
+    )
+    await processor.process_conversation("m0")
+    first = processor._context_cache
+
+    processor.set_system_prompt("new")
+    assert processor._context_cache is None
+    await processor.process_conversation("m1")
+    assert first in caches.deleted
+    assert processor._context_cache["prompt"] == "new"
+    assert_request_matches_cache(processor, calls[-1])
+
+    second = processor._context_cache
+    processor.model = "other-model"
+    await processor.process_conversation("m2")
+    assert second in caches.deleted
+    assert processor._context_cache["model"] == "other-model"
+    assert_request_matches_cache(processor, calls[-1])
+
+
+async def test_load_history_resets_the_cache_anchor(monkeypatch):
+    caches = FakeContextCaches(monkeypatch)
+    calls = answering_stream(monkeypatch)
+    processor = AutoStreamProcessor("key", make_api(), enable_context_cache=True)
+    await processor.process_conversation("m0")
+    await processor.process_conversation("m1")
+    old = processor._context_cache
+
+    donor = AutoStreamProcessor("key", make_api())
+    await donor.process_conversation("other")
+    processor.load_history(donor.get_history())
+    assert processor._cache_anchor == -1
+
+    await processor.process_conversation("m2")
+    assert old in caches.deleted
+    assert processor._context_cache["history"] == donor.get_history()
+    assert_request_matches_cache(processor, calls[-1])
+
+
+async def test_aclose_deletes_every_context_cache(monkeypatch):
+    caches = FakeContextCaches(monkeypatch)
+    answering_stream(monkeypatch)
+    processor = AutoStreamProcessor("key", make_api(), enable_context_cache=True)
+    await processor.process_conversation("m0")
+    processor.clear_history()
+    await processor.process_conversation("m1")
+
+    await processor.aclose()
+
+    assert len(caches.created) == 2
+    assert caches.live == []
+
+
+async def test_aclose_reports_failed_deletions(monkeypatch):
+    caches = FakeContextCaches(monkeypatch)
+    answering_stream(monkeypatch)
+
+    async def failing_delete(cache):
+        raise ValueError("Failed to delete context cache: boom")
+
+    monkeypatch.setattr(auto_stream_processor, "delete_context_cache", failing_delete)
+    processor = AutoStreamProcessor("key", make_api(), enable_context_cache=True)
+    await processor.process_conversation("m0")
+    # A failed deletion during a turn does not break the conversation
+    processor.clear_history()
+    await processor.process_conversation("m1")
+
+    with pytest.raises(ValueError, match="boom"):
+        await processor.aclose()
+    assert processor._context_cache is None
+    assert len(caches.created) == 2
+
+
+def reference_detect(text):
+    """The detector _ToolCodeScanner replaced: rfind the last header, then regex."""
+    header_pos = text.rfind(CALL_HEADER)
+    if header_pos == -1:
+        return None
+    match = re.compile(r"```tool_code\n(.*?)\n```", re.DOTALL).search(text, header_pos)
+    if match is None:
+        return None
+    return match.group(1), match.start(), match.end()
+
+
+def test_scanner_matches_the_reference_detector_over_random_chunkings():
+    pieces = [
+        CALL_HEADER,
+        CALL_HEADER[:20],
+        "```tool_code\n",
+        "\n```",
+        "`",
+        "``",
+        "\n",
+        "print(1)",
+        "text ",
+    ]
+    rng = random.Random(0)
+    scanner = _ToolCodeScanner()
+    for _ in range(3000):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(1, 25)))
+        chunks = []
+        pos = 0
+        while pos < len(text):
+            size = rng.randint(1, 8)
+            chunks.append(text[pos : pos + size])
+            pos += size
+
+        expected = None
+        for index in range(len(chunks)):
+            match = reference_detect("".join(chunks[: index + 1]))
+            if match:
+                expected = (index, match)
+                break
+        scanner.reset()
+        found = None
+        for index, chunk in enumerate(chunks):
+            match = scanner.feed(chunk)
+            if match:
+                found = (index, match)
+                break
+        assert found == expected, chunks
+
+
+async def start_drain(processor, callback):
+    queue = asyncio.Queue()
+    task = asyncio.create_task(processor._drain_stream_callbacks(queue, callback))
+    return queue, task
+
+
+async def test_drain_forwards_chunks_in_order_and_coalesces_backlog():
+    processor = AutoStreamProcessor("key", make_api())
+    received = []
+    release = asyncio.Event()
+
+    async def callback(text, msg_type):
+        assert msg_type is CallbackMsgType.STREAM
+        received.append(text)
+        await release.wait()
+
+    queue, task = await start_drain(processor, callback)
+    queue.put_nowait("a")
+    await asyncio.sleep(0)
+    # The callback is still busy with "a", so these pile up in the queue
+    for chunk in ("b", "c", "d"):
+        queue.put_nowait(chunk)
+    release.set()
+    await asyncio.sleep(0)
+    queue.put_nowait("e")
+    queue.put_nowait(None)
+    await task
+
+    assert received == ["a", "bcd", "e"]
+
+
+async def test_drain_stops_the_stream_when_the_callback_fails():
+    processor = AutoStreamProcessor("key", make_api())
+    processor._stream_state.reset(None)
+    received = []
+
+    async def callback(text, msg_type):
+        received.append(text)
+        raise RuntimeError("callback failed")
+
+    queue, task = await start_drain(processor, callback)
+    queue.put_nowait("a")
+    await asyncio.sleep(0)
+    queue.put_nowait("b")
+    queue.put_nowait(None)
+
+    with pytest.raises(RuntimeError, match="callback failed"):
+        await task
+    assert received == ["a"]
+    assert processor._stream_state.cancellation.is_cancelled()
+    assert queue.empty()
+
+
+@pytest.mark.parametrize("cacheable", [True, False])
+async def test_tool_results_are_cached_only_for_cacheable_apis(monkeypatch, cacheable):
+    turn = (tool_call("print(default_api.count())"), [RESPONSE_HEADER, "done"])
+    scripted_stream(monkeypatch, *turn, *turn)
+    calls = []
+
+    def count():
+        calls.append(None)
+        return len(calls)
+
+    api = DefaultApi(None, cacheable=cacheable)
+    api.add_handler("count", count)
+    processor = AutoStreamProcessor("key", api)
+    events, callback = recorder()
+
+    await processor.process_conversation("first", callback)
+    await processor.process_conversation("second", callback)
+
+    results = [p for p, t in events if t is CallbackMsgType.TOOLCODE_RESULT]
+    if cacheable:
+        assert len(calls) == 1
+        assert results == ["1", "1"]
+    else:
+        assert len(calls) == 2
+        assert results == ["1", "2"]
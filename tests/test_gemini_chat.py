@@ -0,0 +1,203 @@
+"""Tests for the Gemini streaming helpers in autogemini.gemini_chat."""
+
+import asyncio
+import random
+import re
+
+import google.generativeai as genai
+import pytest
+from google.api_core import grpc_helpers_async
+from google.generativeai import protos
+from google.generativeai.types import generation_types
+
+from autogemini import gemini_chat
+from autogemini.gemini_chat import StreamCancellation, _ThoughtFilter
+
+
+def response_proto(text):
+    return protos.GenerateContentResponse(
+        candidates=[{"content": {"role": "model", "parts": [{"text": text}]}}]
+    )
+
+
+class FakeGrpcCall:
+    """Stands in for the grpc.aio call that api_core wraps."""
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.cancelled = False
+
+    def __aiter__(self):
+        return self._responses()
+
+    async def _responses(self):
+        for text in self.texts:
+            yield response_proto(text)
+
+    def cancel(self):
+        self.cancelled = True
+        return True
+
+
+def patch_stream(monkeypatch, call):
+    """Make GenerativeModel stream from `call` through the real SDK wrappers."""
+
+    async def generate_content_async(self, contents=None, **kwargs):
+        stream = grpc_helpers_async._WrappedUnaryStreamCall().with_call(call)
+        return await generation_types.AsyncGenerateContentResponse.from_aiterator(
+            stream
+        )
+
+    monkeypatch.setattr(
+        genai.GenerativeModel, "generate_content_async", generate_content_async
+    )
+
+
+async def test_cancel_stream_call_cancels_the_grpc_call(monkeypatch):
+    call = FakeGrpcCall(["a", "b", "c", "d"])
+    patch_stream(monkeypatch, call)
+    token = StreamCancellation()
+    received = []
+
+    async def callback(text):
+        received.append(text)
+        if text == "b":
+            token.cancel()
+
+    result = await gemini_chat.stream_chat(
+        "key", callback, user_message="hi", cancellation_token=token
+    )
+
+    assert result == "ab"
+    assert received == ["a", "b"]
+    assert call.cancelled
+
+
+async def test_finished_stream_is_not_cancelled(monkeypatch):
+    call = FakeGrpcCall(["a", "b"])
+    patch_stream(monkeypatch, call)
+
+    async def callback(text):
+        pass
+
+    assert await gemini_chat.stream_chat("key", callback, user_message="hi") == "ab"
+    assert not call.cancelled
+
+
+def test_cancel_stream_call_ignores_unknown_iterators():
+    class Response:
+        async def _iterator_gen(self):
+            yield None
+
+    response = Response()
+    response._iterator = response._iterator_gen()
+    # Not api_core's wrapper generator: nothing to cancel and no error
+    gemini_chat._cancel_stream_call(response)
+    gemini_chat._cancel_stream_call(object())
+
+
+def filter_chunks(chunks):
+    thought_filter = _ThoughtFilter()
+    return [thought_filter.feed(chunk) for chunk in chunks] + [thought_filter.flush()]
+
+
+def reference_filter(text):
+    """Filter the whole text at once: drop <thought> blocks and stray tags."""
+    parts = []
+    pos = 0
+    inside = False
+    for match in re.finditer(r"</?thought>", text):
+        if inside:
+            if match.group() == "</thought>":
+                inside = False
+                pos = match.end()
+        else:
+            parts.append(text[pos : match.start()])
+            pos = match.end()
+            inside = match.group() == "<thought>"
+    if not inside:
+        parts.append(text[pos:])
+    return "".join(parts)
+
+
+def test_thought_filter_handles_tags_split_across_chunks():
+    assert filter_chunks(["a<tho", "ught>hidden</th", "ought>b"]) == ["a", "", "b", ""]
+    assert filter_chunks(["a<", "/thought>b"]) == ["a", "b", ""]
+
+
+def test_thought_filter_flushes_text_that_was_not_a_tag():
+    # "<th" could start a tag, so it is held back until the stream ends
+    assert filter_chunks(["x <th"]) == ["x ", "<th"]
+    assert filter_chunks(["x <th", "is"]) == ["x ", "<this", ""]
+    # An unclosed block hides the rest of the output, even at flush
+    assert filter_chunks(["a<thought>b", "c</thou"]) == ["a", "", ""]
+
+
+def test_thought_filter_matches_filtering_the_whole_text():
+    pieces = ["<thought>", "</thought>", "<", "</", "<tho", "ught>", "x", "yz", ">"]
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 12)))
+        chunks = []
+        pos = 0
+        while pos < len(text):
+            size = rng.randint(1, 6)
+            chunks.append(text[pos : pos + size])
+            pos += size
+        assert "".join(filter_chunks(chunks)) == reference_filter(text), chunks
+
+
+def patch_timed_stream(monkeypatch, plan):
+    """Stream one chunk per (delay, text) pair, sleeping before each chunk."""
+
+    class Response:
+        async def __aiter__(self):
+            for delay, text in plan:
+                await asyncio.sleep(delay)
+                yield generation_types.GenerateContentResponse.from_response(
+                    response_proto(text)
+                )
+
+    async def generate_content_async(self, contents=None, **kwargs):
+        return Response()
+
+    monkeypatch.setattr(
+        genai.GenerativeModel, "generate_content_async", generate_content_async
+    )
+
+
+async def test_slow_callbacks_do_not_count_as_a_stall(monkeypatch):
+    patch_timed_stream(monkeypatch, [(0.01, "a"), (0.01, "b")])
+
+    async def slow_callback(text):
+        await asyncio.sleep(0.2)
+
+    result = await gemini_chat.stream_chat(
+        "key", slow_callback, user_message="hi", timeout=0.1
+    )
+    assert result == "ab"
+
+
+async def test_stalled_stream_raises(monkeypatch):
+    patch_timed_stream(monkeypatch, [(0.01, "a"), (1.0, "b")])
+
+    async def callback(text):
+        pass
+
+    with pytest.raises(ValueError, match="stalled"):
+        await gemini_chat.stream_chat("key", callback, user_message="hi", timeout=0.1)
+
+
+async def test_caller_cancellation_is_not_reported_as_a_stall(monkeypatch):
+    patch_timed_stream(monkeypatch, [(0.01, "a"), (1.0, "b")])
+
+    async def callback(text):
+        pass
+
+    task = asyncio.create_task(
+        gemini_chat.stream_chat("key", callback, user_message="hi", timeout=10)
+    )
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
@@ -0,0 +1,93 @@
+"""Tests for DefaultApi dispatch and ToolCodeProcessor in autogemini.tool_code."""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from autogemini.tool_code import DefaultApi, ToolCodeProcessor
+
+
+def thread_name():
+    return threading.current_thread().name
+
+
+async def test_handlers_run_on_the_loop_thread_by_default():
+    async def async_handler():
+        return thread_name()
+
+    def future_handler(value):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(value * 2)
+        return future
+
+    def task_handler(value):
+        async def add_one():
+            return value + 1
+
+        return asyncio.ensure_future(add_one())
+
+    api = DefaultApi(None)
+    api.add_handler("async_handler", async_handler)
+    api.add_handler("sync_handler", thread_name)
+    api.add_handler("future_handler", future_handler)
+    api.add_handler("task_handler", task_handler)
+    main = thread_name()
+
+    assert await api.async_handler() == main
+    assert await api.sync_handler() == main
+    assert await api.future_handler(3) == 6
+    assert await api.task_handler(3) == 4
+
+
+async def test_blocking_handlers_run_in_a_worker_thread():
+    api = DefaultApi(None)
+    api.add_handler("where", thread_name, blocking=True)
+    assert await api.where() != thread_name()
+
+    # Registering again without the flag moves it back to the loop thread
+    api.add_handler("where", thread_name)
+    assert await api.where() == thread_name()
+
+
+async def test_blocking_handlers_use_the_executor():
+    with ThreadPoolExecutor(1, thread_name_prefix="tool-executor") as executor:
+        api = DefaultApi(None, executor=executor)
+        api.add_handler("blocking", thread_name, blocking=True)
+        api.add_handler("plain", thread_name)
+
+        assert (await api.blocking()).startswith("tool-executor")
+        assert await api.plain() == thread_name()
+
+
+async def test_default_handler_dispatch():
+    def default_handler(name, *args):
+        return (name, args, thread_name())
+
+    main = thread_name()
+    name, args, where = await DefaultApi(default_handler).missing(1, 2)
+    assert (name, args, where) == ("missing", (1, 2), main)
+
+    api = DefaultApi(default_handler, default_blocking=True)
+    assert (await api.missing())[2] != main
+
+
+async def test_tool_code_processor_replaces_a_streamed_block():
+    async def add(a, b):
+        return a + b
+
+    api = DefaultApi(None)
+    api.add_handler("add", add)
+    processor = ToolCodeProcessor(api)
+    chunks = ["before ``", "`tool_code\nprint(default_", "api.add(1, 2))\n``", "`after"]
+
+    results = [await processor.process_stream_chunk(chunk) for chunk in chunks]
+
+    assert results[:3] == [(chunk, False) for chunk in chunks[:3]]
+    assert results[3] == ("before (3,)after", True)
+    assert processor.get_remaining_buffer() == ""
+
+
+async def test_tool_code_processor_passes_plain_text_through():
+    processor = ToolCodeProcessor(DefaultApi(None))
+    for chunk in ["no code ", "but `inline` backticks", " and ```python\nx\n```"]:
+        assert await processor.process_stream_chunk(chunk) == (chunk, False)